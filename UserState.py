@@ -1,5 +1,4 @@
 from collections import namedtuple
-from math import floor
 
 Deal = namedtuple('Deal', 'price tickets')
 #should be ordered high to low, too lazy to enforce
@@ -9,25 +8,46 @@ EVENT_PRICES = [
     Deal(price=1, tickets=1)
 ]
 
+
+def _greedy_deal(money_amount):
+    charge = 0
+    tickets = 0
+    for deal in EVENT_PRICES:
+        number_of_sets = money_amount // deal.price
+        charge += number_of_sets * deal.price
+        money_amount -= number_of_sets * deal.price
+        tickets += number_of_sets * deal.tickets
+    return Deal(price=charge, tickets=tickets)
+
+
+# Buying greedily, every full set of the biggest deal is bought first, so
+# only the remainder needs the rest of the deals and that is precomputed
+_BIGGEST_DEAL = EVENT_PRICES[0]
+_REMAINDER_DEALS = [_greedy_deal(remainder) for remainder in range(_BIGGEST_DEAL.price)]
+
+
+def ticket_deal(money_amount):
+    # (charge, tickets) for spending money_amount
+    number_of_sets, remainder = divmod(money_amount, _BIGGEST_DEAL.price)
+    return Deal(price=number_of_sets * _BIGGEST_DEAL.price + _REMAINDER_DEALS[remainder].price,
+                tickets=number_of_sets * _BIGGEST_DEAL.tickets + _REMAINDER_DEALS[remainder].tickets)
+
+
 class UserState:
-    def __init__(self, tickets_available=0, amount_owed=0, bets=[], paid=0):
+    # one of these per participant, so no per-instance __dict__. Open bets are
+    # tracked by the StateEngine rather than on each user.
+    __slots__ = ('tickets_available', 'amount_owed', 'paid')
+
+    def __init__(self, tickets_available=0, amount_owed=0, paid=0):
         self.tickets_available = tickets_available
         self.amount_owed = amount_owed
-        self.bets = bets
         self.paid = paid
 
     def __str__(self):
         return f'Tickets available: {self.tickets_available}, Amount owed: ${self.amount_owed}'
 
     def buyin(self, money_amount):
-        charge = 0
-        tickets = 0
-        for deal in EVENT_PRICES:
-            number_of_sets = floor(money_amount / deal.price)
-            charge += number_of_sets * deal.price
-            money_amount -= number_of_sets * deal.price
-            tickets += number_of_sets * deal.tickets
-
+        charge, tickets = ticket_deal(money_amount)
         self.amount_owed += charge
         self.tickets_available += tickets
     
@@ -0,0 +1,309 @@
+import argparse
+from collections import deque
+from datetime import datetime
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+from file_management import JOURNAL_FILE, read_json_state, user_rows
+from snapshots import SNAPSHOT_DIR, SnapshotStore, parse_snapshot_time
+from sqlite_storage import DB_FILE, read_full_state
+
+AUDIT_DIR = 'audit'
+AUDIT_FILE = 'audit.jsonl'
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 20
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def audit_record(command, actor, args, users, bets, full=False, details=None):
+    # users is user id -> (tickets available, amount owed, paid) after the
+    # change, bets is bet id -> bet info, or None for a bet that closed. A
+    # full record (a load or a rotation) lists everyone and replaces what came
+    # before it. actor is None for what the bot did on its own.
+    # details holds what the command decided that isn't in its arguments,
+    # like the seed a drawing picked.
+    record = {
+        "time": datetime.now().strftime(TIME_FORMAT),
+        "command": command,
+        "actor": actor,
+        "args": list(args),
+        "users": {str(user_id): list(counters) for user_id, counters in users.items()},
+        "bets": bets
+    }
+    if full:
+        record["full"] = True
+    if details:
+        record["details"] = details
+    return record
+
+
+class AuditLog:
+    # Appends every record as one JSON line to directory/audit.jsonl from a
+    # writer thread, so the event loop only ever queues. Once the file passes
+    # max_bytes it becomes audit.jsonl.1, older files move up one and
+    # audit.jsonl.<backups> is deleted. With no backups the file just grows.
+    # The writer replays what it writes as it goes, so each new file starts
+    # with a full record and the oldest file kept can always be replayed.
+    def __init__(self, directory=AUDIT_DIR, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.audit_file = os.path.join(directory, AUDIT_FILE)
+        os.makedirs(directory, exist_ok=True)
+        self._users = {}
+        self._open_bets = {}
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def write(self, record):
+        self._queue.put(record)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        # blocks until everything written before the call is in the file
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = []
+            for item in batch:
+                if isinstance(item, dict):
+                    records.append(item)
+                    continue
+                self._append_all(records)
+                records = []
+                if item is None:
+                    return
+                item.set()
+            self._append_all(records)
+
+    def _append_all(self, records):
+        if not records:
+            return
+        try:
+            self._append(records)
+        except Exception as e:
+            print(f'Failed to write {len(records)} audit records: {e}')
+
+    def _append(self, records):
+        for record in records:
+            apply_record(self._users, self._open_bets, record)
+        with open(self.audit_file, 'a') as audit:
+            audit.write(''.join(json.dumps(record) + '\n' for record in records))
+            audit.flush()
+            os.fsync(audit.fileno())
+            size = audit.tell()
+        if self.backups and size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        oldest = f'{self.audit_file}.{self.backups}'
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for number in range(self.backups - 1, 0, -1):
+            source = f'{self.audit_file}.{number}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.audit_file}.{number + 1}')
+        os.replace(self.audit_file, f'{self.audit_file}.1')
+        with open(self.audit_file, 'w') as audit:
+            audit.write(json.dumps(audit_record('rotate', None, [], self._users, self._open_bets, full=True)) + '\n')
+            audit.flush()
+            os.fsync(audit.fileno())
+
+
+def audit_files(directory):
+    # oldest first, so records come back in the order they were written
+    audit_file = os.path.join(directory, AUDIT_FILE)
+    numbers = sorted((int(name[len(AUDIT_FILE) + 1:]) for name in os.listdir(directory)
+                      if name.startswith(AUDIT_FILE + '.') and name[len(AUDIT_FILE) + 1:].isdigit()), reverse=True)
+    files = [f'{audit_file}.{number}' for number in numbers]
+    if os.path.exists(audit_file):
+        files.append(audit_file)
+    return files
+
+
+def record_matches(record, user=None, bet=None, since=None, until=None):
+    if since and record["time"] < since:
+        return False
+    if until and record["time"] > until:
+        return False
+    if user is not None and str(user) not in record["users"] and record["actor"] != user:
+        return False
+    if bet is not None and str(bet) not in record["bets"]:
+        return False
+    return True
+
+
+def read_records(directory, user=None, bet=None, since=None, until=None):
+    # Streams the matching records out of every rotated file a line at a time.
+    # since and until are datetimes. Lines that can't mention the user or bet
+    # asked for are skipped before they're parsed.
+    since = since.strftime(TIME_FORMAT) if since else None
+    until = until.strftime(TIME_FORMAT) if until else None
+    needles = [str(value) for value in (user, bet) if value is not None]
+    if not os.path.isdir(directory):
+        return
+    for path in audit_files(directory):
+        try:
+            audit = open(path, 'r')
+        except FileNotFoundError:
+            # rotated away while we were reading the others
+            continue
+        with audit:
+            for line in audit:
+                if not all(needle in line for needle in needles):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn final line from a crash mid-write
+                    continue
+                if record_matches(record, user, bet, since, until):
+                    yield record
+
+
+def last_records(directory, count, user=None, bet=None, since=None, until=None):
+    # (number of matching records, the newest count of them)
+    matched = 0
+    last = deque(maxlen=count)
+    for record in read_records(directory, user, bet, since, until):
+        matched += 1
+        last.append(record)
+    return matched, list(last)
+
+
+def describe(record, name=str):
+    # one line for people, name turns a user id into something readable
+    changes = []
+    for user_id, (tickets_available, amount_owed, paid) in record["users"].items():
+        changes.append(f'{name(int(user_id))} {tickets_available} tickets, ${amount_owed} owed, ${paid} paid')
+    for bet_id, bet_info in record["bets"].items():
+        changes.append(f'bet {bet_id} closed' if bet_info is None else f'bet {bet_id} open for {bet_info["amount"]} tickets')
+    if record.get("full"):
+        changes = [f'whole state of {len(record["users"])} users and {len(record["bets"])} open bets']
+    details = ''.join(f' {key}={value}' for key, value in record.get("details", {}).items())
+    actor = name(record["actor"]) if record["actor"] is not None else 'the bot'
+    return f'{record["time"]} {record["command"]} {" ".join(record["args"])}{details} by {actor}: {"; ".join(changes) or "no changes"}'
+
+
+def apply_record(users, open_bets, record):
+    if record.get("full"):
+        users.clear()
+        open_bets.clear()
+    for user_id, counters in record["users"].items():
+        users[int(user_id)] = tuple(counters)
+    for bet_id, bet_info in record["bets"].items():
+        if bet_info is None:
+            open_bets.pop(bet_id, None)
+        else:
+            open_bets[bet_id] = bet_info
+
+
+def replay(records):
+    # the last state every user and bet was audited with
+    users = {}
+    open_bets = {}
+    for record in records:
+        apply_record(users, open_bets, record)
+    return users, open_bets
+
+
+def verify(replayed, game_state, open_bets):
+    # Compares replay() output with the current state. Returns a summary and
+    # a list of problems, empty when everything matches.
+    audited_users, audited_bets = replayed
+    problems = []
+    totals = [0, 0, 0]
+    audited_totals = [0, 0, 0]
+    for user_id, *counters in user_rows(game_state):
+        counters = tuple(counters)
+        totals = [total + value for total, value in zip(totals, counters)]
+        audited = audited_users.get(user_id)
+        if audited is None:
+            problems.append(f'user {user_id} has no audit records')
+        elif audited != counters:
+            problems.append(f'user {user_id} is {counters} but was last audited as {audited}')
+    for user_id, counters in audited_users.items():
+        audited_totals = [total + value for total, value in zip(audited_totals, counters)]
+        if user_id not in game_state:
+            problems.append(f'user {user_id} was audited but is not registered')
+    for bet_id in set(open_bets) ^ set(audited_bets):
+        problems.append(f'bet {bet_id} is {"open" if bet_id in open_bets else "closed"} but the audit log has it {"closed" if bet_id in open_bets else "open"}')
+
+    summary = (f'Replayed {len(audited_users)} users and {len(audited_bets)} open bets. '
+               f'Audited totals: {audited_totals[0]} tickets, ${audited_totals[1]} owed, ${audited_totals[2]} paid. '
+               f'Current totals: {totals[0]} tickets, ${totals[1]} owed, ${totals[2]} paid. '
+               f'{len(problems)} problems')
+    return summary, problems
+
+
+def read_current_state(directory):
+    # a guild's state as the bot would load it, from its database if it has one
+    db_file = os.path.join(directory, DB_FILE)
+    if os.path.exists(db_file):
+        connection = sqlite3.connect(db_file)
+        try:
+            full_game_state = read_full_state(connection)
+        finally:
+            connection.close()
+        if full_game_state is not None:
+            return full_game_state
+    return read_json_state(SnapshotStore(os.path.join(directory, SNAPSHOT_DIR)), journal_file=os.path.join(directory, JOURNAL_FILE))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search a guild\'s audit log, or replay it to check it against the saved state')
+    parser.add_argument('directory', help='the guild\'s state directory, guilds/<guild id> for the bot')
+    parser.add_argument('--user', type=int, help='records changing or sent by this user id')
+    parser.add_argument('--bet', help='records opening or closing this bet id')
+    parser.add_argument('--since', help='YYYY-MM-DD HH:MM, YYYY-MM-DD or HH:MM for today')
+    parser.add_argument('--until', help='YYYY-MM-DD HH:MM, YYYY-MM-DD or HH:MM for today')
+    parser.add_argument('--last', type=int, help='only show the newest this many matches')
+    parser.add_argument('--json', action='store_true', help='print the raw records')
+    parser.add_argument('--verify', action='store_true', help='replay every record and compare with the saved state')
+    args = parser.parse_args()
+
+    audit_directory = os.path.join(args.directory, AUDIT_DIR)
+    if args.verify:
+        full_game_state = read_current_state(args.directory)
+        summary, problems = verify(replay(read_records(audit_directory)), full_game_state["game_state"], full_game_state["open_bets"])
+        print(summary)
+        for problem in problems:
+            print(problem)
+        return
+
+    times = {}
+    for option in ('since', 'until'):
+        text = getattr(args, option)
+        if text:
+            times[option] = parse_snapshot_time(text, whole_day=option == 'until')
+            if times[option] is None:
+                parser.error(f'Could not read --{option} {text}')
+    records = read_records(audit_directory, args.user, args.bet, times.get('since'), times.get('until'))
+    if args.last:
+        records = deque(records, maxlen=args.last)
+    for record in records:
+        print(json.dumps(record) if args.json else describe(record))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+from collections import defaultdict
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ADMIN_ROLE_ID = 1
+GUILD_ID = 1
+COMMAND_PREFIX = '!'
+# a snowflake-sized base so ids hash and sort like real discord ids
+USER_ID_BASE = 700000000000000000
+
+
+class FakeRateLimit:
+    # Discord answers a burst with 429s and discord.py quietly waits them out,
+    # so from a command's point of view a rate limit is just a longer send.
+    def __init__(self, sends, per):
+        self.sends = sends
+        self.per = per
+        self.window_start = 0
+        self.count = 0
+
+    async def wait(self):
+        while True:
+            now = asyncio.get_event_loop().time()
+            if now - self.window_start >= self.per:
+                self.window_start = now
+                self.count = 0
+            if self.count < self.sends:
+                self.count += 1
+                return
+            await asyncio.sleep(self.window_start + self.per - now)
+
+
+class FakeMessageSink:
+    def __init__(self, latency, rate_limit):
+        self.latency = latency
+        self.rate_limit = FakeRateLimit(*rate_limit)
+        self.sent = 0
+        self.sent_chars = 0
+
+    async def send(self, content):
+        await self.rate_limit.wait()
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.sent_chars += len(content)
+
+
+class FakeRole:
+    def __init__(self, role_id):
+        self.id = role_id
+
+
+class FakeUser:
+    def __init__(self, user_id, latency, rate_limit, admin=False):
+        self.id = user_id
+        self.name = f'user{user_id - USER_ID_BASE}'
+        self.display_name = self.name
+        self.mention = f'<@{user_id}>'
+        self.roles = [FakeRole(ADMIN_ROLE_ID)] if admin else []
+        self.dm = FakeMessageSink(latency, rate_limit)
+
+    def __str__(self):
+        return f'{self.name}#0000'
+
+    def __hash__(self):
+        return self.id >> 22
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    async def send(self, content):
+        await self.dm.send(content)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeMessage:
+    def __init__(self, author, mentions, content):
+        self.author = author
+        self.mentions = mentions
+        self.content = content
+
+
+class FakeContext:
+    def __init__(self, command_name, author, mentions, channel, args):
+        self.prefix = COMMAND_PREFIX
+        self.command = command_name
+        self.message = FakeMessage(author, mentions, ' '.join([COMMAND_PREFIX + command_name] + list(args)))
+        self.guild = FakeGuild(GUILD_ID)
+        self._channel = channel
+
+    async def send(self, content):
+        await self._channel.send(content)
+
+
+class LoadTest:
+    def __init__(self, bot_module, args):
+        self.bot = bot_module
+        self.args = args
+        self.rng = random.Random(args.seed)
+        rate_limit = (args.rate_limit_sends, args.rate_limit_seconds)
+        self.channel = FakeMessageSink(args.latency, rate_limit)
+        self.log_channel = FakeMessageSink(args.latency, rate_limit)
+        self.users = [FakeUser(USER_ID_BASE + i, args.latency, rate_limit) for i in range(args.users)]
+        self.admin = FakeUser(USER_ID_BASE + args.users, args.latency, rate_limit, admin=True)
+        self.latencies = defaultdict(list)
+        self.commands_run = 0
+        self._slots = asyncio.Semaphore(args.concurrency)
+
+    async def run_command(self, name, author, *args, mentions=(), content=None):
+        context = FakeContext(name, author, list(mentions), self.channel, args)
+        if content is not None:
+            context.message.content = content
+        command = getattr(self.bot, name)
+        async with self._slots:
+            start = time.perf_counter()
+            await command.callback(context, *args)
+            self.latencies[name].append(time.perf_counter() - start)
+            self.commands_run += 1
+
+    async def phase(self, coroutines):
+        await asyncio.gather(*coroutines)
+
+    def bet_groups(self):
+        return [self.rng.sample(self.users, self.rng.randint(2, self.args.max_bet_size)) for _ in range(self.args.bets)]
+
+    async def run(self):
+        self.bot.log_pipeline = self.bot.LogPipeline(self.log_channel.send, self.bot.MSG_SIZE_LIMIT, self.bot.MSG_COUNT_LIMIT,
+                                                     min_send_interval=0)
+        self.bot.log_pipeline.start()
+
+        start = time.perf_counter()
+        await self.phase([self.run_command('register', user) for user in self.users])
+        await self.phase([self.run_command('buyin', user, f'${self.rng.choice([5, 10, 20, 40])}') for user in self.users])
+
+        await self.phase([self.run_command('bet', group[0], '1', *[user.mention for user in group], mentions=group) for group in self.bet_groups()])
+        await self.phase([self.run_command('standings', user) for user in self.rng.sample(self.users, min(len(self.users), 20))])
+        users_by_id = {user.id: user for user in self.users}
+        settlements = []
+        for bet_id, bet_info in list(self.bot.guild_states.get(GUILD_ID).engine.open_bets.items()):
+            group = [users_by_id[participant] for participant in bet_info["participants"]]
+            settlements.append((bet_id, group[0], self.rng.choice(group)))
+        if self.args.settle_batch:
+            # an admin closing rounds of bets with one wonmany each
+            batches = [settlements[start:start + self.args.settle_batch] for start in range(0, len(settlements), self.args.settle_batch)]
+            await self.phase([self.run_command('wonmany', self.admin, mentions=[winner for _, _, winner in batch],
+                                               content='!wonmany\n' + '\n'.join([f'{bet_id} {winner.mention}' for bet_id, _, winner in batch]))
+                              for batch in batches])
+        else:
+            await self.phase([self.run_command('won', author, bet_id, winner.mention, mentions=[winner]) for bet_id, author, winner in settlements])
+        await self.phase([self.run_command('draw', self.admin, '3', str(self.args.seed))])
+        await self.phase([self.run_command('settleall', self.admin)])
+        # the commands return before their DMs are out
+        await asyncio.gather(*self.bot.delivery_tasks)
+        elapsed = time.perf_counter() - start
+
+        await self.bot.log_pipeline.close()
+        return elapsed
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(load_test, elapsed, written, peak_memory):
+    lines = [f'{load_test.commands_run} commands in {elapsed:.2f}s ({load_test.commands_run / elapsed:.1f} commands/sec)',
+             f'{"command":<10} {"count":>6} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}']
+    for name, latencies in load_test.latencies.items():
+        lines.append(f'{name:<10} {len(latencies):>6} {percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} {max(latencies) * 1000:>9.1f}')
+    lines.append(f'state bytes written: {written}')
+    lines.append(f'log channel: {load_test.log_channel.sent} messages, {load_test.log_channel.sent_chars} chars')
+    lines.append(f'DMs: {sum(user.dm.sent for user in load_test.users + [load_test.admin])}')
+    if peak_memory is not None:
+        lines.append(f'peak traced memory: {peak_memory / 1024 / 1024:.1f} MiB')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the bot commands against a fake in-process discord and report throughput and latency')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--bets', type=int, default=300)
+    parser.add_argument('--max-bet-size', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=100, help='commands in flight at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated seconds per discord send')
+    parser.add_argument('--rate-limit-sends', type=int, default=5)
+    parser.add_argument('--rate-limit-seconds', type=float, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--settle-batch', type=int, default=0, help='close bets with wonmany, this many per command, instead of one won each')
+    parser.add_argument('--storage', choices=('journal', 'sqlite'), default='journal')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows everything down')
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    # bot.py reads its config from the environment and keeps each guild's
+    # state under the working directory, so both are set up before it is imported
+    os.environ.setdefault('BOT_ADMIN_ROLE_ID', str(ADMIN_ROLE_ID))
+    os.environ.setdefault('VENMO_USERNAME', 'benchmark')
+    os.environ['STORAGE_BACKEND'] = args.storage
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    state_directory = tempfile.mkdtemp(prefix='charity-bet-bot-bench-')
+    os.chdir(state_directory)
+
+    if not args.no_memory:
+        tracemalloc.start()
+    import bot as bot_module
+
+    load_test = LoadTest(bot_module, args)
+    elapsed = asyncio.get_event_loop().run_until_complete(load_test.run())
+    peak_memory = None if args.no_memory else tracemalloc.get_traced_memory()[1]
+    guilds = bot_module.guild_states.values()
+    bot_module.guild_states.close()
+    # counted by the storage writer threads as they go, so files that were
+    # truncated or deleted since still count and the audit log doesn't
+    written = sum(guild.storage.bytes_written for guild in guilds)
+
+    output = report(load_test, elapsed, written, peak_memory)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
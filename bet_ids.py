@@ -0,0 +1,20 @@
+class BetIdAllocator:
+    # Ids come from a high-water mark that only moves forward and is saved with
+    # the game state, so handing one out never probes the ids already used.
+    # allocate() never awaits, so two bet commands running on the loop at the
+    # same time can't be given the same id.
+    def __init__(self, next_id=None, used_bet_ids=()):
+        self.used_bet_ids = set(used_bet_ids)
+        if next_id is None:
+            # older snapshots only saved the used ids
+            next_id = max([int(bet_id) + 1 for bet_id in self.used_bet_ids if bet_id.isdigit()], default=0)
+        self.next_id = next_id
+
+    def __contains__(self, bet_id):
+        return bet_id in self.used_bet_ids
+
+    def allocate(self):
+        bet_id = str(self.next_id)
+        self.next_id += 1
+        self.used_bet_ids.add(bet_id)
+        return bet_id
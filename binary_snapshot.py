@@ -0,0 +1,168 @@
+from collections.abc import Mapping
+import mmap
+import struct
+
+from UserState import UserState
+
+MAGIC = b'CBS1'
+VERSION = 1
+# magic, version, seq, next bet id (-1 for none), users, bets, participants, used bet ids, strings
+HEADER = struct.Struct('<4sHqqIIIII')
+# user id, tickets available, amount owed, paid, in the order users were saved
+USER = struct.Struct('<qqqq')
+# user id, user record number, sorted by user id for lookups
+INDEX = struct.Struct('<qI')
+# bet id string, amount, game name string (-1 for none), first participant, participant count
+BET = struct.Struct('<IqiII')
+PARTICIPANT = struct.Struct('<q')
+STRING_REF = struct.Struct('<I')
+
+
+def encode(data):
+    # data is snapshot_data() output: users as (id, tickets, owed, paid) rows
+    strings = []
+    string_ids = {}
+
+    def string_id(text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text.encode('utf-8'))
+        return string_ids[text]
+
+    users = data["users"]
+    bets = []
+    participants = []
+    for bet_id, bet_info in data["open_bets"].items():
+        game_name = string_id(bet_info["game_name"]) if bet_info.get("game_name") else -1
+        bets.append(BET.pack(string_id(bet_id), bet_info["amount"], game_name, len(participants), len(bet_info["participants"])))
+        participants.extend(int(participant) for participant in bet_info["participants"])
+    used_bet_ids = [string_id(bet_id) for bet_id in data["used_bet_ids"]]
+
+    string_offsets = [0]
+    for string in strings:
+        string_offsets.append(string_offsets[-1] + len(string))
+
+    next_bet_id = data.get("next_bet_id")
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, data["seq"], -1 if next_bet_id is None else next_bet_id,
+                    len(users), len(bets), len(participants), len(used_bet_ids), len(strings)),
+        b''.join(USER.pack(*row) for row in users),
+        b''.join(INDEX.pack(user_id, number) for user_id, number in sorted((row[0], number) for number, row in enumerate(users))),
+        b''.join(bets),
+        struct.pack(f'<{len(participants)}q', *participants),
+        struct.pack(f'<{len(used_bet_ids)}I', *used_bet_ids),
+        struct.pack(f'<{len(string_offsets)}I', *string_offsets),
+        b''.join(strings)
+    ])
+
+
+class BinarySnapshot:
+    # Reads a snapshot straight out of a buffer (usually a read only mmap of
+    # the file). Open bets are few and are decoded up front, user records are
+    # only decoded when something asks for them.
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version, self.seq, next_bet_id, self.user_count, bet_count, participant_count, used_count, string_count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a version {VERSION} binary snapshot')
+        self.next_bet_id = None if next_bet_id < 0 else next_bet_id
+        self._users_at = HEADER.size
+        self._index_at = self._users_at + self.user_count * USER.size
+        bets_at = self._index_at + self.user_count * INDEX.size
+        participants_at = bets_at + bet_count * BET.size
+        used_at = participants_at + participant_count * PARTICIPANT.size
+        offsets_at = used_at + used_count * STRING_REF.size
+        strings_at = offsets_at + (string_count + 1) * STRING_REF.size
+
+        offsets = struct.unpack_from(f'<{string_count + 1}I', buffer, offsets_at)
+        strings = [bytes(buffer[strings_at + offsets[i]:strings_at + offsets[i + 1]]).decode('utf-8') for i in range(string_count)]
+        participants = struct.unpack_from(f'<{participant_count}q', buffer, participants_at)
+
+        self.open_bets = {}
+        for bet_id, amount, game_name, first, count in BET.iter_unpack(buffer[bets_at:participants_at]):
+            self.open_bets[strings[bet_id]] = {
+                "amount": amount,
+                "participants": list(participants[first:first + count]),
+                "game_name": strings[game_name] if game_name >= 0 else None
+            }
+        self.used_bet_ids = [strings[string] for string in struct.unpack_from(f'<{used_count}I', buffer, used_at)]
+
+    def record(self, number):
+        return USER.unpack_from(self.buffer, self._users_at + number * USER.size)
+
+    def find(self, user_id):
+        low, high = 0, self.user_count
+        while low < high:
+            middle = (low + high) // 2
+            found_id, number = INDEX.unpack_from(self.buffer, self._index_at + middle * INDEX.size)
+            if found_id < user_id:
+                low = middle + 1
+            elif found_id > user_id:
+                high = middle
+            else:
+                return number
+        return None
+
+    def records(self):
+        return USER.iter_unpack(memoryview(self.buffer)[self._users_at:self._index_at])
+
+
+class LazyGameState(Mapping):
+    # user id -> UserState over a binary snapshot. A user's UserState is only
+    # built the first time it's looked up, so loading costs nothing per user
+    # until a command touches them. Users are never removed, only added.
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._states = {}
+        self._new_users = []
+
+    def __getitem__(self, user_id):
+        state = self._states.get(user_id)
+        if state is None:
+            number = self._snapshot.find(user_id)
+            if number is None:
+                raise KeyError(user_id)
+            _, tickets_available, amount_owed, paid = self._snapshot.record(number)
+            state = self._states[user_id] = UserState(tickets_available=tickets_available, amount_owed=amount_owed, paid=paid)
+        return state
+
+    def __setitem__(self, user_id, state):
+        if user_id not in self._states and self._snapshot.find(user_id) is None:
+            self._new_users.append(user_id)
+        self._states[user_id] = state
+
+    def __contains__(self, user_id):
+        return user_id in self._states or self._snapshot.find(user_id) is not None
+
+    def __iter__(self):
+        for record in self._snapshot.records():
+            yield record[0]
+        yield from self._new_users
+
+    def __len__(self):
+        return self._snapshot.user_count + len(self._new_users)
+
+    def rows(self):
+        # (user id, tickets available, amount owed, paid) for everyone, without building UserStates
+        for record in self._snapshot.records():
+            state = self._states.get(record[0])
+            yield record if state is None else (record[0], state.tickets_available, state.amount_owed, state.paid)
+        for user_id in self._new_users:
+            state = self._states[user_id]
+            yield (user_id, state.tickets_available, state.amount_owed, state.paid)
+
+
+def open_snapshot(path, data=None):
+    # data is the already decompressed file contents, otherwise the file is mapped
+    if data is None:
+        with open(path, 'rb') as snapshot_file:
+            # the mapping stays valid after the file is closed
+            data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    snapshot = BinarySnapshot(data)
+    return {
+        "seq": snapshot.seq,
+        "game_state": LazyGameState(snapshot),
+        "open_bets": snapshot.open_bets,
+        "used_bet_ids": snapshot.used_bet_ids,
+        "next_bet_id": snapshot.next_bet_id
+    }
@@ -1,62 +1,204 @@
+import asyncio
 from dotenv import load_dotenv
 import discord
 from discord.ext import commands
-from math import floor
+from datetime import datetime
+import io
+from math import ceil
+import os
 from os import getenv
-from random import choice
+import re
+import time
 import traceback 
 
-from file_management import save_game_state, load_game_state
-from UserState import UserState, EVENT_PRICES
+from audit import AUDIT_DIR, AuditLog, audit_record, describe, last_records, read_records, replay, verify
+from bulk_import import BUYIN, parse_transactions, reconcile
+from dispatch import DMDispatcher, SendRateLimit
+from file_management import JOURNAL_FILE, GameJournal, load_game_state, serialize_bet, user_rows
+from guilds import GuildRegistry, shard_for
+from log_pipeline import LogPipeline
+from metrics import registry, start_metrics_server
+from raffle import new_seed, simulate_draws, win_chance
+from snapshots import SnapshotStore, parse_snapshot_time
+from sqlite_storage import DB_FILE, SqliteStorage
+from state_engine import NOT_REGISTERED, NOT_ENOUGH_TICKETS
+from users import UserResolver
+from UserState import EVENT_PRICES
 
 load_dotenv()
 
-BOT_ADMIN_ROLE_ID = int(getenv('BOT_ADMIN_ROLE_ID'))
+# comma separated, so each event's server can have its own admin role
+BOT_ADMIN_ROLE_IDS = [int(role_id) for role_id in getenv('BOT_ADMIN_ROLE_ID').split(',')]
 COMMAND_PREFIX = '!'
 MSG_SIZE_LIMIT = 1500
 MSG_COUNT_LIMIT = 5
-game_state = {}
+STANDINGS_PAGE_SIZE = 25
+DRAW_MAX_WINNERS = 100
+SIMULATE_TRIALS = 10000
+SIMULATE_MAX_TRIALS = 100000
+SIMULATE_MAX_PRIZES = DRAW_MAX_WINNERS
+# drawings times prizes, fewer drawings are run when there are many prizes
+SIMULATE_MAX_PICKS = 1000000
+LOG_MAX_QUEUED_LINES = int(getenv('LOG_MAX_QUEUED_LINES', 1000))
+LOG_SEND_INTERVAL = float(getenv('LOG_SEND_INTERVAL', 1.0))
+LOG_OVERFLOW_POLICY = getenv('LOG_OVERFLOW_POLICY', 'drop_oldest')
+# discord allows a bot 50 requests a second in all, this leaves room for
+# channel messages and the log channel while announcements go out
+DM_MAX_CONCURRENT_SENDS = int(getenv('DM_MAX_CONCURRENT_SENDS', 10))
+DM_SENDS_PER_SECOND = float(getenv('DM_SENDS_PER_SECOND', 25))
+DM_RETRIES = int(getenv('DM_RETRIES', 3))
+# journal (JSON journal plus snapshots) or sqlite
+STORAGE_BACKEND = getenv('STORAGE_BACKEND', 'journal')
+# every guild keeps its state in GUILD_DIR/<guild id>, with its snapshots in SNAPSHOT_DIR under that
+GUILD_DIR = getenv('GUILD_DIR', 'guilds')
+SNAPSHOT_DIR = getenv('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_KEEP_LAST = int(getenv('SNAPSHOT_KEEP_LAST', 10))
+SNAPSHOT_KEEP_HOURLY = int(getenv('SNAPSHOT_KEEP_HOURLY', 24))
+SNAPSHOT_KEEP_DAILY = int(getenv('SNAPSHOT_KEEP_DAILY', 30))
+SNAPSHOT_COMPRESS = getenv('SNAPSHOT_COMPRESS', '1') != '0'
+# binary snapshots are mapped and read lazily, json ones are human readable
+SNAPSHOT_FORMAT = getenv('SNAPSHOT_FORMAT', 'binary')
+SNAPSHOTS_LISTED = 20
+# each guild's audit log rolls over to a new file at AUDIT_MAX_BYTES, keeping AUDIT_BACKUPS old ones
+AUDIT_MAX_BYTES = int(getenv('AUDIT_MAX_BYTES', 10 * 1024 * 1024))
+AUDIT_BACKUPS = int(getenv('AUDIT_BACKUPS', 20))
+AUDIT_LISTED = 20
+MENTION_PATTERN = re.compile(r'<@!?(\d+)>')
+METRICS_HOST = getenv('METRICS_HOST', '127.0.0.1')
+# 0 leaves the Prometheus endpoint off, !metrics works either way. Shards serve on METRICS_PORT + SHARD_ID.
+METRICS_PORT = int(getenv('METRICS_PORT', 0))
+# shards.py runs one process per shard, each owning the guilds discord sends it
+SHARD_ID = int(getenv('SHARD_ID', 0))
+SHARD_COUNT = int(getenv('SHARD_COUNT', 1))
+# DMs have no guild, so commands sent by DM go to this guild's event, or the only guild the bot is in
+DEFAULT_GUILD_ID = getenv('DEFAULT_GUILD_ID')
+# the guild that takes over the state older versions kept in the working directory, or the only guild the bot is in
+LEGACY_GUILD_ID = getenv('LEGACY_GUILD_ID')
+LEGACY_STATE_FILES = (JOURNAL_FILE, DB_FILE, DB_FILE + '-wal', DB_FILE + '-shm', SNAPSHOT_DIR)
 
 VENMO_USERNAME_FOR_DONATIONS = f'@{getenv("VENMO_USERNAME")}'
-open_bets = {}
-bet_id_cursor = 0
-used_bet_ids = set()
-bet_id_semaphore = True # green light
+
+
+def open_storage(directory):
+    snapshots = SnapshotStore(os.path.join(directory, SNAPSHOT_DIR), keep_last=SNAPSHOT_KEEP_LAST, keep_hourly=SNAPSHOT_KEEP_HOURLY,
+                              keep_daily=SNAPSHOT_KEEP_DAILY, compress=SNAPSHOT_COMPRESS, snapshot_format=SNAPSHOT_FORMAT)
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(os.path.join(directory, DB_FILE), snapshots=snapshots)
+    return GameJournal(os.path.join(directory, JOURNAL_FILE), snapshots=snapshots)
+
+
+def open_audit(directory):
+    return AuditLog(os.path.join(directory, AUDIT_DIR), max_bytes=AUDIT_MAX_BYTES, backups=AUDIT_BACKUPS)
+
+
+guild_states = GuildRegistry(open_storage, open_audit, GUILD_DIR)
 log_channel = None
-bot = commands.Bot(command_prefix=COMMAND_PREFIX)
+log_pipeline = None
+metrics_runner = None
+# announcement DMs still going out after the command that queued them
+# returned, task -> what it's delivering
+delivery_tasks = {}
+# every dispatcher takes turns from this one, so DM_SENDS_PER_SECOND holds
+# for all the announcements going out at once
+dm_rate_limit = SendRateLimit(DM_SENDS_PER_SECOND)
+
+registry.set_gauge('log_queue_lines', lambda: log_pipeline.pending() if log_pipeline is not None else 0)
+registry.set_gauge('guilds_loaded', lambda: len(guild_states))
+registry.set_gauge('journal_queue_depth', lambda: sum(guild.storage.pending() for guild in guild_states.values()))
+registry.set_gauge('audit_queue_depth', lambda: sum(guild.audit.pending() for guild in guild_states.values()))
+registry.set_gauge('journal_bytes', lambda: sum(guild.storage.journal_bytes for guild in guild_states.values()))
+registry.set_gauge('snapshot_bytes', lambda: sum(guild.storage.snapshot_bytes for guild in guild_states.values()))
+registry.set_gauge('registered_users', lambda: sum(len(guild.engine.game_state) for guild in guild_states.values()))
+registry.set_gauge('open_bets', lambda: sum(len(guild.engine.open_bets) for guild in guild_states.values()))
+registry.set_gauge('deliveries_in_progress', lambda: len(delivery_tasks))
+
+
+class CharityBot(commands.Bot):
+    async def on_command_error(self, context, exception):
+        # has_role checks fail before a command's own wrappers run
+        if isinstance(exception, commands.CheckFailure):
+            registry.inc('permission_denied_total', command=str(context.command))
+        await super().on_command_error(context, exception)
+
+    async def close(self):
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for task, name in list(delivery_tasks.items()):
+            task.cancel()
+            await log(f'{name} messages stopped by shutdown')
+        if log_pipeline is not None:
+            await log_pipeline.close()
+        guild_states.close()
+        await super().close()
+
+
+bot = CharityBot(command_prefix=COMMAND_PREFIX, shard_id=SHARD_ID, shard_count=SHARD_COUNT)
+user_resolver = UserResolver(bot)
 
 
 async def log(msg):
-    if log_channel:
-        split_count = 0
-        while len(msg) > 0 and split_count < MSG_COUNT_LIMIT:
-            await log_channel.send(f'LOG: {msg[:MSG_SIZE_LIMIT]}')
-            msg = msg[MSG_SIZE_LIMIT:]
-            split_count += 1
+    registry.inc('log_lines_total')
+    if log_pipeline is not None:
+        await log_pipeline.put(msg)
     else:
         print(msg)
 
 
-def get_new_bet_id():
-    global bet_id_semaphore, bet_id_cursor
-    while not bet_id_semaphore:
-        continue
-    bet_id_semaphore = False
+def command_args(context):
+    # the words after the command name as they were typed, before a command
+    # turned any of them into numbers
+    return context.message.content.split()[1:]
+
+
+def audit_changes(guild, context, rows, bet_ids, full=False, details=None):
+    # rows are (user id, tickets available, amount owed, paid) after the
+    # change. Without a context it's the bot restoring state on its own.
+    engine = guild.engine
+    guild.audit.write(audit_record(str(context.command) if context else 'restore',
+                                   context.message.author.id if context else None,
+                                   command_args(context) if context else [],
+                                   {row[0]: row[1:] for row in rows},
+                                   {bet_id: serialize_bet(engine.open_bets[bet_id]) if bet_id in engine.open_bets else None for bet_id in bet_ids},
+                                   full, details))
 
-    new_bet_id = str(bet_id_cursor)
-    while new_bet_id in used_bet_ids:
-        bet_id_cursor += 1
-        new_bet_id = str(bet_id_cursor)
-    used_bet_ids.add(new_bet_id)
 
-    bet_id_semaphore = True
-    return new_bet_id
+def report_snapshot_failure(guild, snapshot):
+    if snapshot.cancelled() or snapshot.exception() is None:
+        return
+    registry.inc('snapshot_failures_total')
+    asyncio.ensure_future(log(f'Failed to write a snapshot for guild {guild.guild_id}: {snapshot.exception()}'))
+
+
+def record_changes(guild, context, changes, details=None):
+    # Audits and journals one command's changes, the (users, bets) it got
+    # from engine.take_changes() right after making them, before anything was
+    # awaited, so nothing another command did is mixed in. Returns the journal
+    # commit, which the command waits for before telling anyone about the
+    # change, or None if nothing changed.
+    engine, storage = guild.engine, guild.storage
+    users, bets = changes
+    if not users and not bets:
+        return None
+    audit_changes(guild, context, user_rows({user_id: engine[user_id] for user_id in users if user_id in engine}), bets, details=details)
+    committed = storage.record(engine.game_state, engine.open_bets, engine.bet_ids, users, bets)
+    if storage.should_compact():
+        # nothing waits on the snapshot, so a failure is reported from its callback
+        storage.compact(engine.game_state, engine.open_bets, engine.bet_ids).add_done_callback(
+            lambda snapshot: report_snapshot_failure(guild, snapshot))
+    return committed
+
+
+async def wait_committed(committed):
+    if committed is None:
+        return
+    with registry.timer('state_save_seconds'):
+        await committed
 
 
 def is_admin(user):
     try:
         for role in user.roles:
-            if role.id == BOT_ADMIN_ROLE_ID:
+            if role.id in BOT_ADMIN_ROLE_IDS:
                 return True
     except:
         pass
@@ -66,6 +208,7 @@ def is_admin(user):
 def admin_func(func):
     async def wrapper(context, *args):
         if not is_admin(context.message.author):
+            registry.inc('permission_denied_total', command=str(context.command))
             await log(f'{context.message.author} attempted {context.prefix}{context.command}')
             await context.message.author.send(f'You are not an admin so you cannot execute {context.prefix}{context.command}')
             return
@@ -75,50 +218,157 @@ def admin_func(func):
 
 def log_function_call(func):
     async def wrapper(context, *args):
+        user_resolver.adopt(context.message.author)
+        for mention in context.message.mentions:
+            user_resolver.adopt(mention)
         await log(f'Received {context.prefix}{context.command} {args} from {context.message.author}')
+        start = time.perf_counter()
         try:
             await func(context, *args)
+            registry.inc('commands_total', command=str(context.command), result='success')
         except Exception as e:
+            registry.inc('commands_total', command=str(context.command), result='failure')
             traceback.print_exc() 
             await log(f'{context.prefix}{context.command} {args} from {context.message.author} FAILED:\n{e}\nStack trace logged')
+        registry.observe('command_seconds', time.perf_counter() - start, command=str(context.command))
     return wrapper
 
 
-def save_state(func):
-    async def wrapper(context, *args):
-        await func(context, *args)
-        save_game_state(game_state, open_bets, used_bet_ids)
-    return wrapper
+def user_game_state_message(engine, user):
+    user_state = engine[user.id]
+    user_state_str = f'You are registered with {user_state.tickets_available} tickets available'
+    if user_state.amount_owed:
+        user_state_str += f', you owe ${user_state.amount_owed}' 
+    if user_state.paid:
+        user_state_str += f' and you\'ve paid ${user_state.paid}'
+    user_bets = engine.user_bets(user.id)
+    if user_bets:
+        bet_string = ''
+        for bet_id in user_bets:
+            bet_string += f'\n  - Bet {bet_id}: Pool of {engine.open_bets[bet_id]["amount"]} tickets with {", ".join([user_resolver.get(participant).display_name for participant in engine.open_bets[bet_id]["participants"]])} participating'
+        user_state_str += f'\nYou have {len(user_bets)} open bet{"s" if len(user_bets) != 1 else ""}:{bet_string}'
+    return user_state_str
 
 
-async def send_user_game_state(user):
-    user_state_str = f'You are registered with {game_state[user].tickets_available} tickets available'
-    if game_state[user].amount_owed:
-        user_state_str += f', you owe ${game_state[user].amount_owed}' 
-    if game_state[user].paid:
-        user_state_str += f' and you\'ve paid ${game_state[user].paid}'
-    await user.send(user_state_str)
-    if game_state[user].bets:
-        bet_string = ''
-        for bet_id in game_state[user].bets:
-            bet_string += f'\n  - Bet {bet_id}: Pool of {open_bets[bet_id]["amount"]} tickets with {", ".join([participant.display_name for participant in open_bets[bet_id]["participants"]])} participating'
-        await user.send(f'You have {len(game_state[user].bets)} open bet{"s" if len(game_state[user].bets) != 1 else ""}:{bet_string}')
+async def send_user_game_state(engine, user):
+    await user.send(user_game_state_message(engine, user))
+
+
+def new_dispatcher():
+    return DMDispatcher(max_concurrent_sends=DM_MAX_CONCURRENT_SENDS, rate_limit=dm_rate_limit, retries=DM_RETRIES)
+
+
+def deliver_in_background(dispatcher, name, admin=None, report=None):
+    # A few hundred DMs take a while at the rate discord allows, so the
+    # command returns right away and the summary is logged, and DMed to admin
+    # as "<report>: <summary>", once they're all out.
+    async def deliver():
+        try:
+            summary = await dispatcher.send_all()
+        except Exception as e:
+            await log(f'{name} messages failed: {e}')
+            return
+        await log(f'{name} messages: {summary}')
+        if admin is not None:
+            await admin.send(f'{report}: {summary}')
+
+    task = asyncio.ensure_future(deliver())
+    delivery_tasks[task] = name
+    task.add_done_callback(lambda task: delivery_tasks.pop(task, None))
+    return task
+
+
+async def restore_state(guild, snapshot=None, context=None):
+    # context is the !load that asked for it, if any
+    engine = guild.engine
+    with registry.timer('state_load_seconds'):
+        engine.load(*await load_game_state(user_resolver, guild.storage, snapshot))
+    guild.loaded = True
+    # a load replaces everything, so the audit log gets the whole state to replay from
+    audit_changes(guild, context, user_rows(engine.game_state), engine.open_bets, full=True)
+    # start a fresh journal (or rewrite the database) from whatever was just loaded
+    await guild.storage.compact(engine.game_state, engine.open_bets, engine.bet_ids)
+
+
+async def load_guild(guild_id):
+    guild = guild_states.get(guild_id)
+    if not guild.loaded:
+        async with guild.load_lock:
+            if not guild.loaded:
+                await restore_state(guild)
+                await log(f'Restored {len(guild.engine.game_state)} users and {len(guild.engine.open_bets)} open bets for guild {guild_id}')
+    return guild
+
+
+def guild_id_for(context):
+    if context.guild is not None:
+        return context.guild.id
+    if DEFAULT_GUILD_ID:
+        return int(DEFAULT_GUILD_ID)
+    if len(bot.guilds) == 1:
+        return bot.guilds[0].id
+    return None
+
+
+async def guild_for(context):
+    # the event a command is for, or None once the author has been told why there isn't one
+    guild_id = guild_id_for(context)
+    # another shard's process owns that guild's files
+    if guild_id is None or shard_for(guild_id, SHARD_COUNT) != SHARD_ID:
+        await log(f'{context.message.author} sent {context.prefix}{context.command} outside an event server')
+        await context.message.author.send(f'Use {context.prefix}{context.command} in a channel of the server running the event.')
+        return None
+    return await load_guild(guild_id)
 
 
 @bot.event
 async def on_ready():
-    global log_channel
+    global log_channel, log_pipeline, metrics_runner
     log_channel = bot.get_channel(int(getenv("LOG_CHANNEL")))
-    await log(f'Bot connected as {bot.user}')
+    if log_channel is None:
+        # the log channel's server may be on another shard, which the API doesn't care about
+        try:
+            log_channel = await bot.fetch_channel(int(getenv("LOG_CHANNEL")))
+        except discord.HTTPException:
+            pass
+    if log_channel and log_pipeline is None:
+        log_pipeline = LogPipeline(log_channel.send, MSG_SIZE_LIMIT, MSG_COUNT_LIMIT,
+                                   max_queued_lines=LOG_MAX_QUEUED_LINES,
+                                   min_send_interval=LOG_SEND_INTERVAL,
+                                   overflow_policy=LOG_OVERFLOW_POLICY)
+        log_pipeline.start()
+    if METRICS_PORT and metrics_runner is None:
+        metrics_runner = await start_metrics_server(registry, METRICS_HOST, METRICS_PORT + SHARD_ID)
+        await log(f'Serving metrics on http://{METRICS_HOST}:{METRICS_PORT + SHARD_ID}/metrics')
+    await log(f'Bot connected as {bot.user}{f", shard {SHARD_ID} of {SHARD_COUNT}" if SHARD_COUNT > 1 else ""} in {len(bot.guilds)} guilds')
+
+    legacy_guild_id = int(LEGACY_GUILD_ID) if LEGACY_GUILD_ID else (bot.guilds[0].id if len(bot.guilds) == 1 and SHARD_COUNT == 1 else None)
+    if legacy_guild_id is not None and shard_for(legacy_guild_id, SHARD_COUNT) == SHARD_ID:
+        moved = guild_states.adopt_legacy_state(legacy_guild_id, LEGACY_STATE_FILES)
+        if moved:
+            await log(f'Moved {", ".join(moved)} into {guild_states.directory_for(legacy_guild_id)}')
+
+    # events with saved state are loaded now, new ones on their first command
+    saved_guild_ids = guild_states.saved_guild_ids()
+    for guild in bot.guilds:
+        if guild.id in saved_guild_ids:
+            await load_guild(guild.id)
 
 
 @bot.command(name='register', help=f'usage: {COMMAND_PREFIX}register\nRegister as a participant without buying in yet')
 @log_function_call
 async def register(context):
-    global game_state
-    game_state.setdefault(context.message.author, UserState())
-    await log(f'{context.message.author} registered: {game_state[context.message.author]}')
-    await context.message.author.send(f'You are registered with {game_state[context.message.author].tickets_available} tickets available')
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    async with engine.locked(context.message.author.id):
+        engine.register(context.message.author.id)
+        committed = record_changes(guild, context, engine.take_changes())
+        user_state = engine[context.message.author.id]
+    await wait_committed(committed)
+    await log(f'{context.message.author} registered: {user_state}')
+    await context.message.author.send(f'You are registered with {user_state.tickets_available} tickets available')
     await context.message.author.send(f'Tickets prices are {", ".join([f"${x.price} for {x.tickets} tickets" for x in EVENT_PRICES])}')
     await context.message.author.send(f'Use the following command to buyin: {context.prefix}buyin <amount of money>')
 
@@ -126,22 +376,28 @@ async def register(context):
 @bot.command(name='status', help=f'usage: {COMMAND_PREFIX}status\nGet your current status (money owed, tickets available, and open bets) in a private message')
 @log_function_call
 async def status(context):
-    print(context.guild.roles)
-    global game_state
-    if context.message.author not in game_state:
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    if context.message.author.id not in engine:
         await context.message.author.send(f'You are not registered. Use {context.prefix}register to register')
         return
-    await send_user_game_state(context.message.author)
+    await send_user_game_state(engine, context.message.author)
 
 
 @bot.command(name='buyin', help=f'usage: {COMMAND_PREFIX}buyin <amount of money>\nSpecify the amount of money you are spending and you will be given the correct amount of tickets.\nTickets prices are {", ".join([f"${x.price} for {x.tickets} tickets" for x in EVENT_PRICES])}\nYou may buy in multiple times to replenish your tickets as needed. Deals will not be applied retroactively.\nYou can always check how much money you owe by using the command {COMMAND_PREFIX}status')
 @log_function_call
-@save_state
 async def buyin(context, charge_amt: int):
-    global game_state
-    if context.message.author not in game_state:    
-        game_state.setdefault(context.message.author, UserState())
-        await log(f'{context.message.author} registered: {game_state[context.message.author]}')
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    async with engine.locked(context.message.author.id):
+        if engine.register(context.message.author.id):
+            registration = record_changes(guild, context, engine.take_changes())
+            await wait_committed(registration)
+            await log(f'{context.message.author} registered: {engine[context.message.author.id]}')
     try:
         charge_amt = int(charge_amt.strip().lstrip('$'))
     except:
@@ -149,17 +405,26 @@ async def buyin(context, charge_amt: int):
         await context.message.author.send(f'Invalid input value. Please input a whole number value.')
         return
     
-    await log(f'{context.message.author}: amount owed: ${game_state[context.message.author].amount_owed}, tickets: {game_state[context.message.author].tickets_available} | buying in ${charge_amt}')
-    game_state[context.message.author].buyin(charge_amt)
+    async with engine.locked(context.message.author.id):
+        before = str(engine[context.message.author.id])
+        engine.buyin(context.message.author.id, charge_amt)
+        committed = record_changes(guild, context, engine.take_changes())
+        after = str(engine[context.message.author.id])
+        message = user_game_state_message(engine, context.message.author)
 
-    await log(f'{context.message.author}: amount owed: ${game_state[context.message.author].amount_owed}, tickets: {game_state[context.message.author].tickets_available} | bought in ${charge_amt}')
-    await send_user_game_state(context.message.author)
+    await wait_committed(committed)
+    await log(f'{context.message.author}: {before} | buying in ${charge_amt}')
+    await log(f'{context.message.author}: {after} | bought in ${charge_amt}')
+    await context.message.author.send(message)
 
 
 @bot.command(name='bet', help=f'usage: {COMMAND_PREFIX}bet <number of tickets each person is betting> <optional one word bet name> <mention all participants, including yourself>\nCreate a bet to start a game. Bets can only be created by an admin or a participant.')
 @log_function_call
-@save_state
 async def bet(context, charge_amt: int, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
     try:
         charge_amt = int(charge_amt.strip())
     except:
@@ -169,81 +434,69 @@ async def bet(context, charge_amt: int, *args):
 
 
     if context.message.author not in context.message.mentions and not is_admin(context.message.author):
+        registry.inc('permission_denied_total', command=str(context.command))
         await log(f'Failed to create bet because {context.message.author} is not in the betting group and not an admin')
         await context.message.author.send(f'You do not have permissions to create bets for other people. If you meant to enter a bet including yourself, be sure to mention yourself.')
         return
 
     
-    bet = {
-        "amount": 0,
-        "participants": []
-    }
-
-    if len(args) > len(context.message.mentions):
-        bet["game_name"] = args[0].strip().lower()
-
-
-    should_cancel = False
-    cancel_note = ''
-    for mention in context.message.mentions:
-        if mention not in game_state:
-            should_cancel = True
-            await log(f'Failed to create bet because {mention} is not registered.')
-            await mention.send(f'You are not registered and therefore do not have enough tickets available to place this bet. Use {context.prefix}buyin <amount of money> to add more tickets and try again.')
-            cancel_note = 'Not everyone is registered for the game. Buy in first and try again.'
-        elif game_state[mention].tickets_available < charge_amt:
-            should_cancel = True
-            await log(f'Failed to create bet because {mention} only has {game_state[mention].tickets_available} tickets available.')
-            await mention.send(f'You do not have enough tickets available to place this bet. Use {context.prefix}buyin <amount of money> to add more tickets and try again.')
-            cancel_note = 'Not everyone has enough tickets for this bet. Buy in first and try again.'
-        elif bet.get("game_name") and find_bet_by_game_name(mention, bet.get("game_name")):
-            should_cancel = True
-            await log(f'Failed to create bet because {mention} is already participating in a game named {bet.get("game_name")}.')
-            await mention.send(f'You are already in a game named {bet.get("game_name")}. Use another name!')
-            cancel_note = f'Someone in this bet is participating in another bet named {bet.get("game_name")}. Close out that bet or name this bet differently.'
-    if should_cancel:
+    game_name = args[0].strip().lower() if len(args) > len(context.message.mentions) else None
+
+    mentions = {mention.id: mention for mention in context.message.mentions}
+    async with engine.locked(*mentions):
+        bet_id, problems = engine.create_bet(list(mentions), charge_amt, game_name)
+        committed = record_changes(guild, context, engine.take_changes())
+        if problems:
+            tickets_available = {user_id: engine[user_id].tickets_available for user_id, problem in problems if problem == NOT_ENOUGH_TICKETS}
+        else:
+            bet = engine.open_bets[bet_id]
+
+    await wait_committed(committed)
+    if problems:
+        cancel_note = ''
+        for user_id, problem in problems:
+            mention = mentions[user_id]
+            if problem == NOT_REGISTERED:
+                await log(f'Failed to create bet because {mention} is not registered.')
+                await mention.send(f'You are not registered and therefore do not have enough tickets available to place this bet. Use {context.prefix}buyin <amount of money> to add more tickets and try again.')
+                cancel_note = 'Not everyone is registered for the game. Buy in first and try again.'
+            elif problem == NOT_ENOUGH_TICKETS:
+                await log(f'Failed to create bet because {mention} only has {tickets_available[user_id]} tickets available.')
+                await mention.send(f'You do not have enough tickets available to place this bet. Use {context.prefix}buyin <amount of money> to add more tickets and try again.')
+                cancel_note = 'Not everyone has enough tickets for this bet. Buy in first and try again.'
+            else:
+                await log(f'Failed to create bet because {mention} is already participating in a game named {game_name}.')
+                await mention.send(f'You are already in a game named {game_name}. Use another name!')
+                cancel_note = f'Someone in this bet is participating in another bet named {game_name}. Close out that bet or name this bet differently.'
         await log(f'Bet canceled')
         await context.send(cancel_note)
         return
 
-    bet_id = get_new_bet_id()
-
-    for mention in context.message.mentions:
-        bet["amount"] += charge_amt
-        bet["participants"].append(mention)
-        game_state[mention].bets.append(bet_id)
-        game_state[mention].tickets_available -= charge_amt
-    
-    open_bets[bet_id] = bet
-
     for mention in context.message.mentions:
         await mention.send(f'You have bet {charge_amt} tickets on bet id {bet_id}{" named [" + bet.get("game_name") + "]" if "game_name" in bet else ""}. When the game is over, any participant can finalize the win by typing {context.prefix}won {bet.get("game_name", bet_id)} <mention winning user(s) on one line>\nIf the amount cannot be split evenly, the remainder will be shared in the order the users are mentioned.')
     await context.send(f'Bet {bet_id}{" named [" + bet.get("game_name") + "]" if "game_name" in bet else ""} created for {bet["amount"]} tickets with users {", ".join([x.display_name for x in context.message.mentions])}. GLHF!')
     await log(f'Bet {bet_id}[{bet.get("game_name")}] created for {charge_amt} each, {bet["amount"]} tickets with users {", ".join([x.display_name for x in context.message.mentions])}')
 
 
-def find_bet_by_game_name(author, game_name):
-    for bet_id_candidate in game_state[author].bets:
-        if open_bets[bet_id_candidate].get("game_name") == game_name.strip().lower():
-            return bet_id_candidate
-    return None
-            
-
 @bot.command(name='won', help=f'usage: {COMMAND_PREFIX}won <bet id or game name> <mention all winners>\nCloses an open bet identified by the bet id given. The bet pool is split evenly among all winners mentioned. If it cannot be split evenly, the remainder is given to the first mention(s) in the order given.\nIf completely the bet as an admin and not a participant, you must use the bet id number')
 @log_function_call
-@save_state
 async def won(context, bet_id_or_name: int, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
     try:
         bet_id = str(int(bet_id_or_name.strip()))
     except:
-        bet_id = find_bet_by_game_name(context.message.author, bet_id_or_name)
+        bet_id = engine.find_bet_by_game_name(context.message.author.id, bet_id_or_name)
         
     if bet_id is None:
         await log(f'Failed to find bet {bet_id_or_name}')
         await context.message.author.send(f'Failed to find bet {bet_id_or_name}')
+        return
 
-    if bet_id not in open_bets:
-        if bet_id in used_bet_ids:
+    if bet_id not in engine.open_bets:
+        if bet_id in engine.bet_ids:
             await log(f'Bet id {bet_id} has already been closed')
             await context.send(f'Bet id {bet_id} has already been closed')
         else:
@@ -251,100 +504,247 @@ async def won(context, bet_id_or_name: int, *args):
             await context.send(f'Bet id {bet_id} is not valid')
         return
 
-    bet = open_bets[bet_id]
+    bet = engine.open_bets[bet_id]
+    participant_names = ", ".join([user_resolver.get(p).display_name for p in bet["participants"]])
 
-    if context.message.author not in bet["participants"] or not is_admin(context.message.author):
-        await log(f'Failed to close bet because {context.message.author} is not in the betting group {", ".join([p.display_name for p in bet["participants"]])} and not an admin')
+    if context.message.author.id not in bet["participants"] and not is_admin(context.message.author):
+        registry.inc('permission_denied_total', command=str(context.command))
+        await log(f'Failed to close bet because {context.message.author} is not in the betting group {participant_names} and not an admin')
         await context.send(f'{context.message.author.mention} You do not have permissions to close bets for other people.')
         return
 
+    if not context.message.mentions:
+        await log(f'Failed to close bet because no winners were mentioned')
+        await context.send(f'Mention the winner(s) of bet {bet_id} to close it.')
+        return
+
     for mention in context.message.mentions:
-        if mention not in bet["participants"]:
-            await log(f'Failed to close bet because {mention} is not in the betting group {", ".join([p.display_name for p in bet["participants"]])}')
+        if mention.id not in bet["participants"]:
+            await log(f'Failed to close bet because {mention} is not in the betting group {participant_names}')
             await context.send(f'{mention} cannot win a bet in which they were not participants.')
             return
 
+    async with engine.locked(*bet["participants"]):
+        # someone else may have closed it while we waited for the locks
+        if bet_id not in engine.open_bets:
+            await log(f'Bet id {bet_id} has already been closed')
+            await context.send(f'Bet id {bet_id} has already been closed')
+            return
+        awards = [(winner, amount_awarded, engine[winner].tickets_available) for winner, amount_awarded in engine.settle_bet(bet_id, [mention.id for mention in context.message.mentions])]
+        committed = record_changes(guild, context, engine.take_changes())
 
-    amount_per_winner = floor(bet["amount"] / len(context.message.mentions))
-    remainder = bet["amount"] - len(context.message.mentions) * amount_per_winner
+    await wait_committed(committed)
+    for winner, amount_awarded, tickets_available in awards:
+        mention = user_resolver.get(winner)
+        await log(f'{amount_awarded} tickets awarded to {mention}. They now have {tickets_available} tickets available.')
+        await mention.send(f'You have been awarded {amount_awarded} tickets. You now have {tickets_available} tickets available. Congrats!')
 
-    for mention in context.message.mentions:
-        if remainder > 0:
-            remainder -= 1
-            amount_awarded = amount_per_winner + 1
+    await context.send(f'Bet {bet_id} completed with the winners: {", ".join([x.display_name for x in context.message.mentions])}. Congrats!')
+    await log(f'Bet {bet_id} completed with winners {", ".join([x.display_name for x in context.message.mentions])}')
+
+
+def settlement_lines(context):
+    # everything after the command name, one bet per line
+    lines = context.message.content.split('\n')
+    first_line = lines[0].split(None, 1)
+    lines[0] = first_line[1] if len(first_line) > 1 else ''
+    return [line.strip() for line in lines if line.strip()]
+
+
+def settlement_problems(engine, context, settlements):
+    problems = []
+    seen = []
+    for bet_ref, bet_id, winners in settlements:
+        if bet_id is None or bet_id not in engine.bet_ids:
+            problems.append(f'Bet {bet_ref} is not valid')
+        elif bet_id not in engine.open_bets:
+            problems.append(f'Bet id {bet_id} has already been closed')
+        elif bet_id in seen:
+            problems.append(f'Bet id {bet_id} is listed more than once')
+        elif context.message.author.id not in engine.open_bets[bet_id]["participants"] and not is_admin(context.message.author):
+            registry.inc('permission_denied_total', command=str(context.command))
+            problems.append(f'You do not have permissions to close bet {bet_id}')
+        elif not winners:
+            problems.append(f'No winners mentioned for bet {bet_id}')
         else:
-            amount_awarded = amount_per_winner
-        
-        game_state[mention].tickets_available += amount_awarded
+            for winner in winners:
+                if winner not in engine.open_bets[bet_id]["participants"]:
+                    problems.append(f'{user_resolver.get(winner).display_name} cannot win bet {bet_id} because they were not participants')
+        seen.append(bet_id)
+    return problems
 
-        await log(f'{amount_awarded} tickets awarded to {mention}. They now have {game_state[mention].tickets_available} tickets available.')
-        await mention.send(f'You have been awarded {amount_awarded} tickets. You now have {game_state[mention].tickets_available} tickets available. Congrats!')
-    
-    for participant in bet["participants"]:
-        game_state[participant].bets.remove(bet_id)
 
-    del open_bets[bet_id]
+@bot.command(name='wonmany', help=f'usage: {COMMAND_PREFIX}wonmany <one bet per line: bet id or game name followed by the winner mentions>\nCloses several bets at once. Every bet is checked first and if any line has a problem no bets are closed. Pools are split as in {COMMAND_PREFIX}won.')
+@log_function_call
+async def wonmany(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    settlements = []
+    for line in settlement_lines(context):
+        bet_ref = line.split()[0]
+        try:
+            bet_id = str(int(bet_ref))
+        except:
+            bet_id = engine.find_bet_by_game_name(context.message.author.id, bet_ref)
+        # dict.fromkeys drops repeated mentions but keeps their order for the remainder
+        settlements.append((bet_ref, bet_id, list(dict.fromkeys(int(user_id) for user_id in MENTION_PATTERN.findall(line)))))
+
+    if not settlements:
+        await context.message.author.send(f'List one bet per line after {context.prefix}wonmany, each followed by its winners.')
+        return
+
+    problems = settlement_problems(engine, context, settlements)
+    if not problems:
+        participants = {participant for _, bet_id, _ in settlements for participant in engine.open_bets[bet_id]["participants"]}
+        async with engine.locked(*participants):
+            # someone else may have closed one of them while we waited for the locks
+            problems = settlement_problems(engine, context, settlements)
+            if not problems:
+                results = engine.settle_bets([(bet_id, winners) for _, bet_id, winners in settlements])
+                committed = record_changes(guild, context, engine.take_changes())
+                tickets_available = {winner: engine[winner].tickets_available for _, awards in results for winner, _ in awards}
+
+    if problems:
+        await log(f'{context.prefix}wonmany from {context.message.author} closed no bets:\n' + '\n'.join(problems))
+        await context.message.author.send('No bets were closed:\n' + '\n'.join(problems))
+        return
 
-    await context.send(f'Bet {bet_id} completed with the winners: {", ".join([x.display_name for x in context.message.mentions])}. Congrats!')
-    await log(f'Bet {bet_id} completed with winners {", ".join([x.display_name for x in context.message.mentions])}')
+    await wait_committed(committed)
+    dispatcher = new_dispatcher()
+    summary = []
+    for bet_id, awards in results:
+        for winner, amount_awarded in awards:
+            dispatcher.add(user_resolver.get(winner), f'Bet {bet_id}: you have been awarded {amount_awarded} tickets.')
+        summary.append(f'Bet {bet_id} completed with the winners: {", ".join([user_resolver.get(winner).display_name for winner, _ in awards])}')
+    for winner, tickets in tickets_available.items():
+        dispatcher.add(user_resolver.get(winner), f'You now have {tickets} tickets available. Congrats!')
 
+    message = f'{len(results)} bets completed. Congrats!\n' + '\n'.join(summary)
+    for start in range(0, len(message), MSG_SIZE_LIMIT):
+        await context.send(message[start:start + MSG_SIZE_LIMIT])
+    await log('\n'.join(summary))
+    deliver_in_background(dispatcher, 'wonmany')
 
-@bot.command(name='await ', help=f'usage: {COMMAND_PREFIX}standings\nPrints the current standings in order.')
-@log_function_call
-async def standings(context, *args):
+
+def render_standings(engine, title, count, start=0):
     FORMAT_STRING = '\n{rank:4d} {name} {tickets} ticket{ticket_s}'
-    current_standings = 'Current standings:'
-    count = 1
+    current_standings = title
 
-    for user, user_state in sorted(game_state.items(), key=lambda item: item[1].tickets_available, reverse=True):
-        current_standings += FORMAT_STRING.format(rank=count,
-                                                  name=user.mention,
-                                                  tickets=user_state.tickets_available,
-                                                  ticket_s='' if user_state.tickets_available == 1 else 's')
-        count += 1
+    for rank, user_id, tickets in engine.leaderboard.top(count, start):
+        current_standings += FORMAT_STRING.format(rank=rank,
+                                                  name=user_resolver.get(user_id).mention,
+                                                  tickets=tickets,
+                                                  ticket_s='' if tickets == 1 else 's')
+    return current_standings
 
-    await context.send(current_standings)
-    await log(f'Standings output')
 
-@bot.command(name='openbets', help=f'usage: {COMMAND_PREFIX}openbets\nPrints the open bets in order they were created.')
-@log_function_call
-async def openbets(context, *args):
+def render_open_bets(engine):
     FORMAT_STRING = '\n{id:4d} {name} {tickets} tickets: {participants}'
-    current_open_bets = 'Open bets:'
+    pages = []
+    current_open_bets = ''
+
+    for bet_id, bet_info in engine.open_bets.items():
+        line = FORMAT_STRING.format(id=int(bet_id),
+                                    name=bet_info.get("game_name", "-"),
+                                    tickets=bet_info["amount"],
+                                    participants=' '.join([user_resolver.get(p).mention for p in bet_info["participants"]]))
+        if current_open_bets and len(current_open_bets) + len(line) > MSG_SIZE_LIMIT:
+            pages.append(current_open_bets)
+            current_open_bets = ''
+        current_open_bets += line
+    pages.append(current_open_bets)
+    return pages
+
+
+@bot.command(name='standings', help=f'usage: {COMMAND_PREFIX}standings <optional: page number, top <count> or me>\nPrints the current standings in order, {STANDINGS_PAGE_SIZE} users per page. Use top <count> for the leaders or me for your own rank.')
+@log_function_call
+async def standings(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    page_count = max(1, ceil(len(engine.leaderboard) / STANDINGS_PAGE_SIZE))
+    try:
+        if args and args[0].strip().lower() == 'me':
+            rank = engine.leaderboard.rank(context.message.author.id)
+            if rank is None:
+                await context.message.author.send(f'You are not registered. Use {context.prefix}register to register')
+            else:
+                tickets = engine[context.message.author.id].tickets_available
+                await context.send(f'{context.message.author.mention} is ranked {rank} of {len(engine.leaderboard)} with {tickets} ticket{"" if tickets == 1 else "s"}')
+            return
+        elif args and args[0].strip().lower() == 'top':
+            count = min(max(int(args[1].strip()) if len(args) > 1 else STANDINGS_PAGE_SIZE, 1), STANDINGS_PAGE_SIZE)
+            key = ('top', count)
+            render = lambda: render_standings(engine, f'Top {count}:', count)
+        else:
+            page = min(max(int(args[0].strip()) if args else 1, 1), page_count)
+            key = ('page', page)
+            render = lambda: render_standings(engine, f'Current standings (page {page} of {page_count}):', STANDINGS_PAGE_SIZE, (page - 1) * STANDINGS_PAGE_SIZE)
+    except:
+        await log(f'Failed to convert arguments {args} to a page or count')
+        await context.message.author.send(f'Invalid input value. Use a page number, top <count> or me.')
+        return
 
-    for bet_id, bet_info in open_bets.items():
-        current_open_bets += FORMAT_STRING.format(id=int(bet_id),
-                                                  name=bet_info.get("game_name", "-"),
-                                                  tickets=bet_info["amount"],
-                                                  participants=' '.join([p.mention for p in bet_info["participants"]]))
+    await context.send(guild.standings_cache.get(key, engine.standings_version, render))
+    await log(f'Standings output')
 
+@bot.command(name='openbets', help=f'usage: {COMMAND_PREFIX}openbets <optional: page number>\nPrints the open bets in order they were created, one page at a time.')
+@log_function_call
+async def openbets(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    pages = guild.open_bets_cache.get('pages', engine.open_bets_version, lambda: render_open_bets(engine))
+    try:
+        page = min(max(int(args[0].strip()) if args else 1, 1), len(pages))
+    except:
+        await log(f'Failed to convert first argument [{args[0]}] to an int')
+        await context.message.author.send(f'Invalid input value. Please input a whole number value.')
+        return
 
-    await context.send(current_open_bets)
+    await context.send(f'Open bets{f" (page {page} of {len(pages)})" if len(pages) > 1 else ""}:{pages[page - 1]}')
     await log(f'Open bets output')
 
 
 @bot.command(name='paid', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}paid <amount> <mention 1 or more users>\nMarks users as having paid the amount given')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
-@save_state
 async def paid(context, amount:int, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
     try:
         amount = int(amount.strip().lstrip('$'))
     except:
         await log(f'Failed to convert first argument [{amount}] to an int')
         await context.message.author.send(f'Invalid input value. Please input a whole number value.')
         return
-    for mention in context.message.mentions:
-        game_state[mention].pay(amount)
-        await log(f'{mention.mention} has now paid ${game_state[mention].paid} and still owes ${game_state[mention].amount_owed}')
-        await send_user_game_state(mention)
+    mentions = [mention for mention in context.message.mentions if mention.id in engine]
+    async with engine.locked(*[mention.id for mention in mentions]):
+        for mention in mentions:
+            engine.pay(mention.id, amount)
+        committed = record_changes(guild, context, engine.take_changes())
+        messages = [(mention, engine[mention.id].paid, engine[mention.id].amount_owed, user_game_state_message(engine, mention)) for mention in mentions]
+
+    await wait_committed(committed)
+    for mention, total_paid, amount_owed, message in messages:
+        await log(f'{mention.mention} has now paid ${total_paid} and still owes ${amount_owed}')
+        await mention.send(message)
 
 
 @bot.command(name='set', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}set <ticket count> <amount owed> <amount paid> <mention 1 or more users>\nSets users to a given state')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
-@save_state
 async def set(context, ticket_count:int, amount_owed:int, amount_paid:int, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
     try:
         ticket_count = int(ticket_count.strip())
         amount_owed = int(amount_owed.strip().lstrip('$'))
@@ -353,80 +753,397 @@ async def set(context, ticket_count:int, amount_owed:int, amount_paid:int, *args
         await log(f'Failed to convert first argument [{ticket_count}, {amount_owed}, or {amount_paid}] to an int')
         await context.message.author.send(f'Invalid input value. Please input a whole number value.')
         return
-    for mention in context.message.mentions:
-        game_state[mention] = UserState(tickets_available=ticket_count, amount_owed=amount_owed, paid=amount_paid)
-        await log(f'{mention.mention} set to {game_state[mention].tickets_available} tickets, ${game_state[mention].amount_owed} owed, ${game_state[mention].paid} paid')
-        await send_user_game_state(mention)
+    async with engine.locked(*[mention.id for mention in context.message.mentions]):
+        for mention in context.message.mentions:
+            engine.set_user(mention.id, tickets_available=ticket_count, amount_owed=amount_owed, paid=amount_paid)
+        committed = record_changes(guild, context, engine.take_changes())
+        messages = [(mention, user_game_state_message(engine, mention)) for mention in context.message.mentions]
+
+    await wait_committed(committed)
+    for mention, message in messages:
+        await log(f'{mention.mention} set to {ticket_count} tickets, ${amount_owed} owed, ${amount_paid} paid')
+        await mention.send(message)
+
+
+def user_counters(engine, user_ids):
+    return {user_id: (engine[user_id].tickets_available, engine[user_id].amount_owed, engine[user_id].paid) if user_id in engine else None
+            for user_id in user_ids}
+
+
+@bot.command(name='import', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}import <attach a CSV or JSON file>\nApplies buy-ins and payments in bulk. Each row has user_id, amount and type (buyin or payment); CSV columns are in that order unless there is a header row. Every row is checked first and if any has a problem nothing is imported. You get a reconciliation report back.')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
+@log_function_call
+async def import_transactions(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    if not context.message.attachments:
+        await context.message.author.send(f'Attach a CSV or JSON file of user_id, amount, type rows to {context.prefix}import.')
+        return
+    attachment = context.message.attachments[0]
+    transactions, problems = parse_transactions(await attachment.read(), attachment.filename)
+
+    # a payment needs the user registered already or bought in earlier in the file
+    first_buyin = {}
+    for transaction in transactions:
+        if transaction.kind == BUYIN:
+            first_buyin.setdefault(transaction.user_id, transaction.line)
+        elif transaction.user_id not in engine and first_buyin.get(transaction.user_id, transaction.line) >= transaction.line:
+            problems.append(f'line {transaction.line}: {transaction.user_id} is not registered, so they cannot pay')
+    if not transactions and not problems:
+        problems.append(f'{attachment.filename} has no rows')
+
+    if problems:
+        await log(f'Import of {attachment.filename} rejected with {len(problems)} problems')
+        message = f'Nothing was imported from {attachment.filename}:\n' + '\n'.join(problems)
+        for start in range(0, min(len(message), MSG_SIZE_LIMIT * MSG_COUNT_LIMIT), MSG_SIZE_LIMIT):
+            await context.message.author.send(message[start:start + MSG_SIZE_LIMIT])
+        return
+
+    user_ids = {transaction.user_id for transaction in transactions}
+    async with engine.locked(*user_ids):
+        before = user_counters(engine, user_ids)
+        engine.apply_transactions(transactions)
+        committed = record_changes(guild, context, engine.take_changes())
+        after = user_counters(engine, user_ids)
+        messages = [(user_resolver.get(user_id), user_game_state_message(engine, user_resolver.get(user_id))) for user_id in user_ids]
+
+    await wait_committed(committed)
+    summary, report = reconcile(transactions, before, after)
+    await log(f'{attachment.filename}: {summary}')
+    await context.message.author.send(summary, file=discord.File(io.BytesIO(report.encode('utf-8')), filename='reconciliation.csv'))
+
+    dispatcher = new_dispatcher()
+    for user, message in messages:
+        dispatcher.add(user, message)
+    deliver_in_background(dispatcher, 'import')
 
 
 @bot.command(name='settleall', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}settleall\nLogs the amount owed by each person and the total amount to be collected.')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
 async def settleall(context, *args):
-    total_owed = 0
-    total_paid = 0
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    dispatcher = new_dispatcher()
 
-    for user, state in game_state.items():
+    for user_id, state in engine.game_state.items():
+        user = user_resolver.get(user_id)
         if state.amount_owed > 0:
-            await user.send(f'Your current total amount owed is ${state.amount_owed}. Be sure to send this amount to the venmo account {VENMO_USERNAME_FOR_DONATIONS} or donate directly via one of the Extra Life links in #welcome by the end of the event!')
+            dispatcher.add(user, f'Your current total amount owed is ${state.amount_owed}. Be sure to send this amount to the venmo account {VENMO_USERNAME_FOR_DONATIONS} or donate directly via one of the Extra Life links in #welcome by the end of the event!')
             if state.paid > 0:
-                await user.send(f'You have already paid ${state.paid}.')
+                dispatcher.add(user, f'You have already paid ${state.paid}.')
         await log(f'{user}: owes ${state.amount_owed}, paid ${state.paid}')
-        total_owed += state.amount_owed
-        total_paid += state.paid
+    total_owed, total_paid = engine.totals()
     await log(f'total owed: ${total_owed}, total paid: ${total_paid}')
 
+    await context.message.author.send(f'Sending settle up messages to {len(dispatcher)} users, you\'ll get a summary when they\'re delivered.')
+    deliver_in_background(dispatcher, 'settleall', context.message.author, 'Settle up messages delivered')
+
 
 @bot.command(name='resetuser', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}resetuser <mention 1 or more users>\nResets each user\'s game state to 0 - used for troubleshooting only')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
-@save_state
 async def resetuser(context, *args):
-    for mention in context.message.mentions:
-        game_state[mention] = UserState()
-        await send_user_game_state(mention)
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    async with engine.locked(*[mention.id for mention in context.message.mentions]):
+        for mention in context.message.mentions:
+            engine.set_user(mention.id)
+        committed = record_changes(guild, context, engine.take_changes())
+        messages = [(mention, user_game_state_message(engine, mention)) for mention in context.message.mentions]
+
+    await wait_committed(committed)
+    for mention, message in messages:
+        await mention.send(message)
 
 
 @bot.command(name='drawprep', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}drawprep\nSends a message to all particpants detailing their current status and announcing the drawing will be happening soon. Also prints out the current standings as in {COMMAND_PREFIX}standings')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
 async def drawprep(context, *args):
-    for user in game_state.keys():
-        await user.send('The drawing is about to happen! Get in your final bets and buyins!')
-        await send_user_game_state(user)
-        if game_state[user].bets:
-            user.send('Be sure to close all open bets before the drawing. Tickets in open bet pools are lost when the winners are drawn!')
-    await standings()
-
-
-@bot.command(name='draw', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}draw\nDraws one winner from the group proportional to the number of tickets available for each person. The winning ticket is removed from the pot.')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    dispatcher = new_dispatcher()
+    for user_id in engine.game_state:
+        user = user_resolver.get(user_id)
+        dispatcher.add(user, 'The drawing is about to happen! Get in your final bets and buyins!')
+        dispatcher.add(user, user_game_state_message(engine, user))
+        if engine.user_bets(user_id):
+            dispatcher.add(user, 'Be sure to close all open bets before the drawing. Tickets in open bet pools are lost when the winners are drawn!')
+
+    await context.message.author.send(f'Sending drawing announcements to {len(dispatcher)} users, you\'ll get a summary when they\'re delivered.')
+    deliver_in_background(dispatcher, 'drawprep', context.message.author, 'Drawing announcements delivered')
+    await standings(context)
+
+
+@bot.command(name='draw', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}draw <optional: number of winners, up to {DRAW_MAX_WINNERS}> <optional: seed>\nDraws winners from the group proportional to the number of tickets available for each person. Each winning ticket is removed from the pot before the next winner is drawn. The seed is logged so a drawing can be reproduced.')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
-@save_state
 async def draw(context, *args):
-    all_entries = []
-    for user, state in game_state.items():
-        all_entries += [user] * state.tickets_available
-        await log(f'{user}: {state.tickets_available}')
-    await log(f'Entries in drawing: {", ".join([entry.display_name for entry in all_entries])}')
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    try:
+        winner_count = int(args[0].strip()) if args else 1
+        seed = int(args[1].strip()) if len(args) > 1 else new_seed()
+    except:
+        await log(f'Failed to convert arguments {args} to ints')
+        await context.message.author.send(f'Invalid input value. Please input whole number values.')
+        return
+    if not 1 <= winner_count <= DRAW_MAX_WINNERS:
+        await log(f'Refused to draw {winner_count} winners')
+        await context.message.author.send(f'The number of winners must be between 1 and {DRAW_MAX_WINNERS}.')
+        return
 
-    if not len(all_entries):
+    await log(f'Entries in drawing: {engine.ticket_pool.total} tickets from {len(engine.ticket_pool)} users, drawing {winner_count} with seed {seed}')
+    winner_ids = engine.draw(winner_count, seed)
+    # the seed and winners go in the audit record with the tickets the drawing
+    # took, before anything is awaited, and nobody hears who won until it's saved
+    committed = record_changes(guild, context, engine.take_changes(), {"seed": seed, "winners": winner_ids})
+    await wait_committed(committed)
+    winners = [user_resolver.get(winner) for winner in winner_ids]
+    if not winners:
         await log('No entries, no winner')
         return
 
-    winner = choice(all_entries)
-    game_state[winner].tickets_available -= 1
-    await log(f'Winner: {winner}')
-    await context.send(f'And the winner is {winner.mention}!!')
+    for winner in winners:
+        await log(f'Winner: {winner}')
+    # one mention never straddles two messages
+    message = f'And the winner{"s are" if len(winners) != 1 else " is"} '
+    for position, winner in enumerate(winners):
+        mention = winner.mention + ('!!' if position == len(winners) - 1 else ', ')
+        if len(message) + len(mention) > MSG_SIZE_LIMIT:
+            await context.send(message)
+            message = ''
+        message += mention
+    await context.send(message)
+
+
+@bot.command(name='odds', help=f'usage: {COMMAND_PREFIX}odds <optional: number of prizes>\nSends you your chance of winning the drawing with the tickets you have now, for one prize or the number of prizes given. Nothing is drawn.')
+@log_function_call
+async def odds(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    try:
+        prizes = int(args[0].strip()) if args else 1
+        if prizes < 1:
+            raise ValueError(prizes)
+    except:
+        await log(f'Failed to convert first argument [{args[0]}] to a number of prizes')
+        await context.message.author.send(f'Invalid input value. Please input a whole number of prizes.')
+        return
+
+    if context.message.author.id not in engine:
+        await context.message.author.send(f'You are not registered. Use {context.prefix}register to register')
+        return
+    tickets = engine.ticket_pool.tickets(context.message.author.id)
+    total = engine.ticket_pool.total
+    if not tickets:
+        await context.message.author.send(f'You have no tickets in the drawing. Use {context.prefix}buyin <amount of money> to get some.')
+        return
+    message = f'You have {tickets} of the {total} tickets in the drawing, a {win_chance(tickets, total):.2%} chance of winning a single draw'
+    if prizes > 1:
+        message += f' and a {win_chance(tickets, total, prizes):.2%} chance of winning at least one of {prizes} prizes'
+    await context.message.author.send(message)
+
+
+async def render_simulation(engine, trials, prizes):
+    FORMAT_STRING = '\n{rank:4d} {name} {tickets} tickets: {simulated:.2%} simulated, {exact:.2%} exact'
+    # everything the drawings need is copied here, then they run on another
+    # thread so commands keep being answered while they do
+    items = engine.ticket_pool.items()
+    total = engine.ticket_pool.total
+    top = engine.leaderboard.top(STANDINGS_PAGE_SIZE)
+    seed = new_seed()
+    with registry.timer('simulation_seconds'):
+        wins = await asyncio.get_event_loop().run_in_executor(None, simulate_draws, items, prizes, trials, seed)
+    message = f'{trials} simulated drawings of {prizes} prize{"s" if prizes != 1 else ""} from {total} tickets held by {len(items)} users (seed {seed}). Chance of winning at least one prize:'
+    for rank, user_id, tickets in top:
+        if tickets <= 0:
+            break
+        message += FORMAT_STRING.format(rank=rank,
+                                        name=user_resolver.get(user_id).display_name,
+                                        tickets=tickets,
+                                        simulated=wins.get(user_id, 0) / trials,
+                                        exact=win_chance(tickets, total, prizes))
+    return message
+
+
+@bot.command(name='simulate', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}simulate <optional: number of drawings> <optional: number of prizes>\nRuns {SIMULATE_TRIALS} (up to {SIMULATE_MAX_TRIALS}, and up to {SIMULATE_MAX_PICKS} drawings times prizes) practice drawings of up to {SIMULATE_MAX_PRIZES} prizes without changing anything and sends you how often the top {STANDINGS_PAGE_SIZE} users won, next to their exact chances. Results are reused until tickets change.')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
+@log_function_call
+async def simulate(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    try:
+        trials = min(max(int(args[0].strip()) if args else SIMULATE_TRIALS, 1), SIMULATE_MAX_TRIALS)
+        prizes = int(args[1].strip()) if len(args) > 1 else 1
+    except:
+        await log(f'Failed to convert arguments {args} to ints')
+        await context.message.author.send(f'Invalid input value. Please input whole number values.')
+        return
+    if not 1 <= prizes <= SIMULATE_MAX_PRIZES:
+        await context.message.author.send(f'The number of prizes must be between 1 and {SIMULATE_MAX_PRIZES}.')
+        return
+    trials = min(trials, SIMULATE_MAX_PICKS // prizes)
+
+    if not engine.ticket_pool.total:
+        await context.message.author.send('No one has tickets in the drawing yet.')
+        return
+    version = engine.standings_version
+    message = guild.odds_cache.cached((trials, prizes), version)
+    if message is None:
+        message = await render_simulation(engine, trials, prizes)
+        # tickets that changed while it ran make it stale for the next ask
+        if engine.standings_version == version:
+            guild.odds_cache.put((trials, prizes), version, message)
+    for start in range(0, len(message), MSG_SIZE_LIMIT):
+        await context.message.author.send(message[start:start + MSG_SIZE_LIMIT])
+    await log(f'Simulation output for {trials} drawings of {prizes} prizes')
+
+
+def render_metrics():
+    lines = ['Commands:']
+    for labels, histogram in registry.histograms_named('command_seconds'):
+        command = labels['command']
+        lines.append(f'  {command}: {registry.counter("commands_total", command=command, result="success")} ok, '
+                     f'{registry.counter("commands_total", command=command, result="failure")} failed, '
+                     f'{registry.counter("permission_denied_total", command=command)} denied, '
+                     f'p50 {histogram.quantile(0.5) * 1000:.0f}ms, p99 {histogram.quantile(0.99) * 1000:.0f}ms')
+    lines.append('I/O:')
+    for name, label in (('state_save_seconds', 'save'), ('state_load_seconds', 'load'), ('log_send_seconds', 'log send'), ('dm_send_seconds', 'DM send')):
+        for labels, histogram in registry.histograms_named(name):
+            lines.append(f'  {label}: {histogram.count} calls, p50 {histogram.quantile(0.5) * 1000:.0f}ms, p99 {histogram.quantile(0.99) * 1000:.0f}ms')
+    lines.append(f'DMs: {registry.counter("dm_sends_total", result="sent")} sent, {registry.counter("dm_sends_total", result="failed")} failed, '
+                 f'{registry.counter("dm_sends_total", result="closed")} closed, {registry.counter("dm_send_retries_total")} retries')
+    lines.append(f'Log: {registry.gauge("log_queue_lines")} lines queued, {registry.counter("log_lines_dropped_total")} dropped')
+    lines.append(f'Journal: {registry.gauge("journal_queue_depth")} writes queued, {registry.gauge("journal_bytes")} bytes, last snapshot {registry.gauge("snapshot_bytes")} bytes, '
+                 f'{registry.counter("snapshot_failures_total")} snapshots failed')
+    lines.append(f'State: {registry.gauge("guilds_loaded")} guilds, {registry.gauge("registered_users")} users, {registry.gauge("open_bets")} open bets')
+    return '\n'.join(lines)
+
+
+@bot.command(name='metrics', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}metrics\nSends you command latency and success counts, queue depths and state file sizes')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
+@log_function_call
+async def metrics(context, *args):
+    message = render_metrics()
+    for start in range(0, len(message), MSG_SIZE_LIMIT):
+        await context.message.author.send(message[start:start + MSG_SIZE_LIMIT])
 
 
-@bot.command(name='load', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}load <optional: filename>\nSpecify the amount of money you are spending and you will be given the correct amount of tickets.\nTickets prices are {", ".join([f"${x.price} for {x.tickets} tickets" for x in EVENT_PRICES])}\nYou may buy in multiple times to replenish your tickets as needed. Deals will not be applied retroactively.\nYou can always check how much money you owe by using the command {COMMAND_PREFIX}status')
-@commands.has_role(BOT_ADMIN_ROLE_ID)
+@bot.command(name='load', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}load <optional: snapshot name or time>\nReloads the game state. With no argument the latest state is loaded, otherwise the newest snapshot taken at or before the time given (YYYY-MM-DD HH:MM, YYYY-MM-DD or HH:MM for today). Use {COMMAND_PREFIX}snapshots to see what is available.')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
+@log_function_call
+async def load(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    snapshot = None
+    if args:
+        snapshot = guild.storage.snapshots.find(' '.join(args).strip())
+        if snapshot is None:
+            await log(f'No snapshot matches {" ".join(args)}')
+            await context.message.author.send(f'No snapshot matches {" ".join(args)}. Use {context.prefix}snapshots to see what is available.')
+            return
+        # Rolling back starts a fresh journal from the older snapshot, so the
+        # state being replaced is saved as a snapshot of its own first. Again
+        # if anything changed while it was written, so nothing is left only
+        # in the journal.
+        while True:
+            seq = guild.storage.seq
+            await guild.storage.keep_snapshot(engine.game_state, engine.open_bets, engine.bet_ids)
+            if guild.storage.seq == seq:
+                break
+    await restore_state(guild, snapshot, context)
+    await log(f'Loaded {snapshot["file"] if snapshot else "latest state"}: {len(engine.game_state)} users and {len(engine.open_bets)} open bets')
+    await context.message.author.send(f'Loaded {snapshot["file"] if snapshot else "the latest state"} with {len(engine.game_state)} users and {len(engine.open_bets)} open bets'
+                                      + (f'. The state before it was saved as a snapshot, use {context.prefix}snapshots to find it.' if snapshot else ''))
+
+
+@bot.command(name='snapshots', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}snapshots <optional: count>\nLists the newest saved snapshots, {SNAPSHOTS_LISTED} by default, that {COMMAND_PREFIX}load can pick by time')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
 @log_function_call
-@commands.has_role(BOT_ADMIN_ROLE_ID)
-async def load(context, file_name: str=None):
-    global game_state, open_bets, used_bet_ids
-    game_state, open_bets, used_bet_ids = await load_game_state(bot, file_name)
+async def list_snapshots(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    try:
+        count = int(args[0].strip()) if args else SNAPSHOTS_LISTED
+    except:
+        await log(f'Failed to convert first argument [{args[0]}] to an int')
+        await context.message.author.send(f'Invalid input value. Please input a whole number value.')
+        return
+
+    entries = guild.storage.snapshots.entries[-count:] if count > 0 else []
+    message = f'{len(guild.storage.snapshots.entries)} snapshots, newest last:'
+    for entry in entries:
+        message += f'\n{datetime.fromtimestamp(entry["time"]):%Y-%m-%d %H:%M:%S}  {entry["file"]}  {entry["bytes"]} bytes'
+    for start in range(0, len(message), MSG_SIZE_LIMIT):
+        await context.message.author.send(message[start:start + MSG_SIZE_LIMIT])
+
+
+@bot.command(name='audit', help=f'[ADMIN ONLY] usage: {COMMAND_PREFIX}audit <optional: mention a user> <optional: bet <bet id>> <optional: since <time>> <optional: until <time>>\nSends you the newest {AUDIT_LISTED} audit records matching all the filters given. Times are YYYY-MM-DD HH:MM, YYYY-MM-DD or HH:MM for today. {COMMAND_PREFIX}audit verify replays the whole audit log and checks it against the current balances.')
+@commands.has_any_role(*BOT_ADMIN_ROLE_IDS)
+@log_function_call
+async def audit(context, *args):
+    guild = await guild_for(context)
+    if guild is None:
+        return
+    engine = guild.engine
+    loop = asyncio.get_event_loop()
+    # the files are read on another thread so a long scan doesn't hold up other commands
+    await loop.run_in_executor(None, guild.audit.flush)
+
+    if args and args[0].strip().lower() == 'verify':
+        replayed = await loop.run_in_executor(None, lambda: replay(read_records(guild.audit.directory)))
+        summary, problems = verify(replayed, engine.game_state, engine.open_bets)
+        await log(f'Audit verify: {summary}')
+        message = summary + ''.join(f'\n{problem}' for problem in problems[:AUDIT_LISTED])
+        for start in range(0, len(message), MSG_SIZE_LIMIT):
+            await context.message.author.send(message[start:start + MSG_SIZE_LIMIT])
+        return
+
+    filters = {}
+    keyword = None
+    for arg in args:
+        word = arg.strip()
+        if word.lower() in ('bet', 'since', 'until'):
+            keyword = word.lower()
+            filters[keyword] = ''
+        elif MENTION_PATTERN.fullmatch(word):
+            keyword = None
+        elif keyword is not None:
+            filters[keyword] = f'{filters[keyword]} {word}'.strip()
+    user = context.message.mentions[0].id if context.message.mentions else None
+    since = parse_snapshot_time(filters['since'], whole_day=False) if filters.get('since') else None
+    until = parse_snapshot_time(filters['until']) if filters.get('until') else None
+    if (filters.get('since') and since is None) or (filters.get('until') and until is None) or ('bet' in filters and not filters['bet']):
+        await log(f'Failed to read audit filters {args}')
+        await context.message.author.send(f'Invalid filters. Use a mention, bet <bet id>, since <time> or until <time>.')
+        return
+
+    matched, records = await loop.run_in_executor(None, lambda: last_records(guild.audit.directory, AUDIT_LISTED, user, filters.get('bet'), since, until))
+    message = f'{matched} matching audit records{f", newest {len(records)}" if matched > len(records) else ""}:'
+    for record in records:
+        message += '\n' + describe(record, lambda user_id: user_resolver.get(user_id).display_name)
+    for start in range(0, len(message), MSG_SIZE_LIMIT):
+        await context.message.author.send(message[start:start + MSG_SIZE_LIMIT])
 
 
-bot.run(getenv("TOKEN"))
\ No newline at end of file
+if __name__ == '__main__':
+    bot.run(getenv("TOKEN"))
@@ -0,0 +1,107 @@
+from collections import namedtuple
+import csv
+from decimal import Decimal, InvalidOperation
+import io
+import json
+
+from UserState import ticket_deal
+
+BUYIN = 'buyin'
+PAYMENT = 'payment'
+KINDS = {
+    'buyin': BUYIN,
+    'buy-in': BUYIN,
+    'buy': BUYIN,
+    'payment': PAYMENT,
+    'paid': PAYMENT,
+    'pay': PAYMENT
+}
+FIELDS = ('user_id', 'amount', 'type')
+
+Transaction = namedtuple('Transaction', 'line user_id amount kind')
+
+
+def _is_user_id(text):
+    return text.strip().lstrip('<@!').rstrip('>').isdigit()
+
+
+def _rows(text, file_name):
+    # (line number, row dict) from a CSV file or a JSON list / JSON lines file
+    stripped = text.lstrip()
+    if file_name.lower().endswith(('.json', '.jsonl')) or stripped.startswith(('[', '{')):
+        if stripped.startswith('['):
+            yield from enumerate(json.loads(text), start=1)
+            return
+        for line, raw in enumerate(text.splitlines(), start=1):
+            if raw.strip():
+                yield line, json.loads(raw)
+        return
+
+    reader = csv.reader(io.StringIO(text))
+    header = None
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        # a header row names the columns, otherwise they're user id, amount, type
+        if header is None and not _is_user_id(row[0]):
+            header = [cell.strip().lower() for cell in row]
+            continue
+        yield reader.line_num, dict(zip(header or FIELDS, row))
+
+
+def parse_transactions(data, file_name=''):
+    # returns (transactions, problems), every row is checked even after a bad one
+    transactions = []
+    problems = []
+    try:
+        text = data.decode('utf-8-sig')
+        rows = list(_rows(text, file_name))
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        return [], [f'Could not read {file_name or "the file"}: {e}']
+
+    for line, row in rows:
+        try:
+            user_id = int(str(row["user_id"]).strip().lstrip('<@!').rstrip('>'))
+            amount = Decimal(str(row["amount"]).strip().lstrip('$'))
+            kind = KINDS[str(row.get("type") or BUYIN).strip().lower()]
+        except (KeyError, ValueError, TypeError, AttributeError, InvalidOperation):
+            problems.append(f'line {line}: expected {", ".join(FIELDS)} (buyin or payment), got {row}')
+            continue
+        if not amount.is_finite() or amount <= 0 or amount != amount.to_integral_value():
+            problems.append(f'line {line}: amount must be a positive whole number of dollars, got {row["amount"]}')
+            continue
+        transactions.append(Transaction(line=line, user_id=user_id, amount=int(amount), kind=kind))
+    return transactions, problems
+
+
+def reconcile(transactions, before, after):
+    # before and after map user id -> (tickets available, amount owed, paid), or None if unregistered.
+    # Returns a short summary and a per user CSV report.
+    totals = {}
+    for transaction in transactions:
+        user_totals = totals.setdefault(transaction.user_id, [0, 0, 0, 0])
+        if transaction.kind == BUYIN:
+            charge, tickets = ticket_deal(transaction.amount)
+            user_totals[0] += charge
+            user_totals[1] += tickets
+        else:
+            user_totals[2] += transaction.amount
+        user_totals[3] += 1
+
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(['user_id', 'rows', 'bought_in', 'tickets_added', 'paid', 'owed_before', 'owed_after', 'paid_after', 'tickets_after', 'balanced'])
+    unbalanced = []
+    for user_id, (charged, tickets, paid, row_count) in totals.items():
+        tickets_before, owed_before, paid_before = before.get(user_id) or (0, 0, 0)
+        tickets_after, owed_after, paid_after = after[user_id]
+        balanced = (owed_after == owed_before + charged - paid and paid_after == paid_before + paid and tickets_after == tickets_before + tickets)
+        if not balanced:
+            unbalanced.append(user_id)
+        writer.writerow([user_id, row_count, charged, tickets, paid, owed_before, owed_after, paid_after, tickets_after, 'yes' if balanced else 'NO'])
+
+    summary = (f'Imported {len(transactions)} rows for {len(totals)} users: '
+               f'${sum(user_totals[0] for user_totals in totals.values())} bought in for {sum(user_totals[1] for user_totals in totals.values())} tickets, '
+               f'${sum(user_totals[2] for user_totals in totals.values())} paid, '
+               f'{len(unbalanced)} users not balanced{": " + ", ".join(str(user_id) for user_id in unbalanced) if unbalanced else ""}')
+    return summary, report.getvalue()
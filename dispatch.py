@@ -0,0 +1,107 @@
+import asyncio
+import discord
+
+from metrics import registry
+
+DM_SIZE_LIMIT = 2000
+
+
+class DeliverySummary:
+    def __init__(self):
+        self.sent = 0
+        self.failed = []
+        self.closed = []
+
+    def __str__(self):
+        summary = f'{self.sent} sent, {len(self.failed)} failed, {len(self.closed)} with closed DMs'
+        if self.failed:
+            summary += f'\nFailed: {", ".join([str(user) for user in self.failed])}'
+        if self.closed:
+            summary += f'\nClosed DMs: {", ".join([str(user) for user in self.closed])}'
+        return summary
+
+
+class SendRateLimit:
+    # Starts sends no faster than sends_per_second. Dispatchers that share one
+    # split that budget between them, however many announcements overlap.
+    def __init__(self, sends_per_second=25.0):
+        self.sends_per_second = sends_per_second
+        self._next_start = 0
+
+    async def wait(self):
+        now = asyncio.get_event_loop().time()
+        start = max(now, self._next_start)
+        self._next_start = start + 1 / self.sends_per_second
+        await asyncio.sleep(start - now)
+
+
+class DMDispatcher:
+    # Collects everything an announcement needs to tell each user, then sends
+    # one merged DM per recipient with several recipients in flight at once.
+    # Sends wait their turn with rate_limit, a SendRateLimit of its own unless
+    # one is passed in, and transient failures are retried with backoff.
+    def __init__(self, max_concurrent_sends=10, rate_limit=None, retries=3):
+        self.max_concurrent_sends = max_concurrent_sends
+        self.rate_limit = rate_limit or SendRateLimit()
+        self.retries = retries
+        self._messages = {}
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, user, message):
+        self._messages.setdefault(user, []).append(message)
+
+    async def send_all(self):
+        summary = DeliverySummary()
+        slots = asyncio.Semaphore(self.max_concurrent_sends)
+        messages, self._messages = self._messages, {}
+        await asyncio.gather(*[self._deliver(user, parts, slots, summary) for user, parts in messages.items()])
+        return summary
+
+    @staticmethod
+    def _split(parts):
+        chunks = []
+        current = ''
+        for part in parts:
+            while len(part) > DM_SIZE_LIMIT:
+                if current:
+                    chunks.append(current)
+                    current = ''
+                chunks.append(part[:DM_SIZE_LIMIT])
+                part = part[DM_SIZE_LIMIT:]
+            if current and len(current) + len(part) + 1 > DM_SIZE_LIMIT:
+                chunks.append(current)
+                current = ''
+            current = f'{current}\n{part}' if current else part
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _deliver(self, user, parts, slots, summary):
+        async with slots:
+            for chunk in self._split(parts):
+                for attempt in range(self.retries + 1):
+                    await self.rate_limit.wait()
+                    try:
+                        with registry.timer('dm_send_seconds'):
+                            await user.send(chunk)
+                        break
+                    except discord.Forbidden:
+                        registry.inc('dm_sends_total', result='closed')
+                        summary.closed.append(user)
+                        return
+                    except discord.HTTPException as e:
+                        if (e.status != 429 and e.status < 500) or attempt == self.retries:
+                            registry.inc('dm_sends_total', result='failed')
+                            summary.failed.append(user)
+                            return
+                    except (asyncio.TimeoutError, OSError):
+                        if attempt == self.retries:
+                            registry.inc('dm_sends_total', result='failed')
+                            summary.failed.append(user)
+                            return
+                    registry.inc('dm_send_retries_total')
+                    await asyncio.sleep(2 ** attempt)
+            registry.inc('dm_sends_total', result='sent')
+            summary.sent += 1
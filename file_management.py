@@ -1,47 +1,283 @@
-from datetime import datetime
+import asyncio
 import json
 import os
+import queue
+import threading
 
+from bet_ids import BetIdAllocator
+from binary_snapshot import LazyGameState
+from snapshots import SnapshotStore
 from UserState import UserState
 
-FILE_SUFFIX = '-game_state.json'
-
-def save_game_state(game_state, open_bets, used_bet_ids):
-    with open(datetime.now().strftime('%y%m%d%H%M%S') + FILE_SUFFIX, 'w') as save_file:
-        json.dump({
-            "game_state": {user.id: user_state.__dict__ for user, user_state in game_state.items()},
-            "open_bets": {bet_id: {
-                "amount": bet_info["amount"],
-                "participants": [participant.id for participant in bet_info["participants"]],
-                "game_name": bet_info.get("game_name")
-            } for bet_id, bet_info in open_bets.items()},
-            "used_bet_ids": list(used_bet_ids)
-        }, save_file)
-
-
-async def load_game_state(bot, file_name=None):
-    if not file_name:
-        files = sorted([candidate_file for candidate_file in os.listdir() if candidate_file.endswith(FILE_SUFFIX)], reverse=True)
-        if not files:
-            return {}, {}, set()
-        file_name = files[0]
-        
-    with open(file_name, 'r') as load_file:
-        full_game_state = json.load(load_file)
-        open_bets = {}
-        for bet_id, bet_info in full_game_state["open_bets"].items():
-            open_bets[bet_id] = {
-                "amount": bet_info["amount"],
-                "participants": [await bot.fetch_user(participant_id) for participant_id in bet_info["participants"]]
-            }
-            if bet_info.get("game_name"):
-                open_bets[bet_id]["game_name"] = bet_info.get("game_name")
-
-        
-        return ({await bot.fetch_user(int(user_id)): UserState(tickets_available=user_state["tickets_available"],
-                                                      amount_owed=user_state["amount_owed"],
-                                                      bets=user_state["bets"],
-                                                      paid=user_state.get("paid", 0)
-                                                     ) for user_id, user_state in full_game_state["game_state"].items()},
-                open_bets,
-                set(full_game_state["used_bet_ids"]))
\ No newline at end of file
+JOURNAL_FILE = 'game_state.journal'
+COMPACT_EVERY = 200
+
+
+def serialize_user_state(user_state):
+    return {
+        "tickets_available": user_state.tickets_available,
+        "amount_owed": user_state.amount_owed,
+        "paid": user_state.paid
+    }
+
+
+def serialize_bet(bet_info):
+    return {
+        "amount": bet_info["amount"],
+        "participants": list(bet_info["participants"]),
+        "game_name": bet_info.get("game_name")
+    }
+
+
+def deserialize_user_state(user_state):
+    return UserState(tickets_available=user_state["tickets_available"],
+                     amount_owed=user_state["amount_owed"],
+                     paid=user_state.get("paid", 0))
+
+
+def user_rows(game_state):
+    # (user id, tickets available, amount owed, paid) for every user, without
+    # building a UserState for users a lazily loaded snapshot hasn't needed yet
+    if isinstance(game_state, LazyGameState):
+        return list(game_state.rows())
+    return [(user_id, user_state.tickets_available, user_state.amount_owed, user_state.paid) for user_id, user_state in game_state.items()]
+
+
+def snapshot_data(game_state, open_bets, bet_ids, seq=0):
+    return {
+        "seq": seq,
+        "users": user_rows(game_state),
+        "open_bets": {bet_id: serialize_bet(bet_info) for bet_id, bet_info in open_bets.items()},
+        "used_bet_ids": list(bet_ids.used_bet_ids),
+        "next_bet_id": bet_ids.next_id
+    }
+
+
+class Storage:
+    # Base for the storage backends. Each command hands over one small record
+    # of the users and bets it touched. A single writer thread does all the
+    # I/O so the event loop never blocks, and every record queued while it was
+    # busy is committed together. Subclasses set their own fields before
+    # calling this __init__, which starts the writer.
+    def __init__(self, compact_every=COMPACT_EVERY, snapshots=None):
+        self.compact_every = compact_every
+        self.snapshots = snapshots or SnapshotStore()
+        self.seq = 0
+        self.records_since_snapshot = 0
+        # sizes in bytes, set by the writer thread and read for metrics
+        self.snapshot_bytes = 0
+        self.journal_bytes = 0
+        # what _commit and _snapshot report writing, added up, so it still
+        # counts what compaction or retention removed since
+        self.bytes_written = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def record(self, game_state, open_bets, bet_ids, users, changed_bet_ids):
+        self.seq += 1
+        self.records_since_snapshot += 1
+        entry = {
+            "seq": self.seq,
+            "game_state": {user_id: serialize_user_state(game_state[user_id]) for user_id in users if user_id in game_state},
+            "open_bets": {bet_id: serialize_bet(open_bets[bet_id]) if bet_id in open_bets else None for bet_id in changed_bet_ids},
+            "next_bet_id": bet_ids.next_id
+        }
+        return self._put('record', self._encode(entry))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def should_compact(self):
+        return self.records_since_snapshot >= self.compact_every
+
+    def compact(self, game_state, open_bets, bet_ids):
+        self.records_since_snapshot = 0
+        return self._put('snapshot', snapshot_data(game_state, open_bets, bet_ids, self.seq))
+
+    def keep_snapshot(self, game_state, open_bets, bet_ids):
+        # a snapshot that leaves the journal (or database) alone, so the state
+        # is still there to load after rolling back to an older one
+        return self._put('keep', snapshot_data(game_state, open_bets, bet_ids, self.seq))
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+    def read_state(self, snapshot=None):
+        # returns the whole state in the snapshot format, from the given
+        # snapshot manifest entry or from wherever the backend keeps it
+        raise NotImplementedError
+
+    def _encode(self, entry):
+        return entry
+
+    def _commit(self, entries):
+        # returns the bytes written, as does _snapshot
+        raise NotImplementedError
+
+    def _snapshot(self, data):
+        raise NotImplementedError
+
+    def _put(self, kind, payload):
+        done = asyncio.get_event_loop().create_future()
+        self._queue.put((kind, payload, done))
+        return done
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if self._write_batch(batch):
+                return
+
+    def _write_batch(self, batch):
+        # True once close() has been asked for
+        pending_entries = []
+        pending_done = []
+        for item in batch:
+            if item is None:
+                self._commit_all(pending_entries, pending_done)
+                return True
+            kind, payload, done = item
+            if kind == 'record':
+                pending_entries.append(payload)
+                pending_done.append(done)
+            else:
+                self._commit_all(pending_entries, pending_done)
+                pending_entries, pending_done = [], []
+                self._run(done, self._snapshot if kind == 'snapshot' else self.snapshots.write, payload)
+        self._commit_all(pending_entries, pending_done)
+        return False
+
+    def _commit_all(self, entries, done):
+        if not entries:
+            return
+        try:
+            self.bytes_written += self._commit(entries)
+        except Exception as e:
+            for future in done:
+                self._resolve(future, e)
+            return
+        for future in done:
+            self._resolve(future)
+
+    def _run(self, done, func, *args):
+        # func returns the bytes it wrote
+        try:
+            self.bytes_written += func(*args)
+        except Exception as e:
+            self._resolve(done, e)
+            return
+        self._resolve(done)
+
+    @staticmethod
+    def _resolve(future, error=None):
+        def set_result():
+            if future.cancelled():
+                return
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+        future.get_loop().call_soon_threadsafe(set_result)
+
+
+class GameJournal(Storage):
+    # Records are appended to a JSON lines journal with one fsync per batch,
+    # and compaction writes a timestamped snapshot and empties the journal.
+    def __init__(self, journal_file=JOURNAL_FILE, compact_every=COMPACT_EVERY, snapshots=None):
+        self.journal_file = journal_file
+        super().__init__(compact_every, snapshots)
+        self.journal_bytes = os.path.getsize(journal_file) if os.path.exists(journal_file) else 0
+
+    def read_state(self, snapshot=None):
+        return read_json_state(self.snapshots, snapshot, self.journal_file)
+
+    def _encode(self, entry):
+        return json.dumps(entry)
+
+    def _commit(self, lines):
+        with open(self.journal_file, 'a') as journal:
+            start = journal.tell()
+            journal.write('\n'.join(lines) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+            self.journal_bytes = journal.tell()
+        return self.journal_bytes - start
+
+    def _snapshot(self, data):
+        self.snapshot_bytes = self.snapshots.write(data)
+        # everything in the journal so far is covered by the snapshot
+        open(self.journal_file, 'w').close()
+        self.journal_bytes = 0
+        return self.snapshot_bytes
+
+
+def read_journal(journal_file, after_seq):
+    if not os.path.exists(journal_file):
+        return
+    with open(journal_file, 'r') as journal:
+        for line in journal:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a torn final line from a crash mid-write
+                break
+            if record["seq"] > after_seq:
+                yield record
+
+
+def read_json_state(snapshots, snapshot=None, journal_file=JOURNAL_FILE):
+    # the journal only applies on top of the newest snapshot, not one picked by time
+    replay_journal = snapshot is None
+    snapshot = snapshot or snapshots.latest()
+    full_game_state = {"seq": 0, "game_state": {}, "open_bets": {}, "used_bet_ids": []}
+    if snapshot:
+        full_game_state.update(snapshots.read(snapshot))
+    if not replay_journal:
+        return full_game_state
+
+    used_bet_ids = set(full_game_state["used_bet_ids"])
+    for record in read_journal(journal_file, full_game_state["seq"]):
+        for user_id, user_state in record["game_state"].items():
+            full_game_state["game_state"][int(user_id)] = deserialize_user_state(user_state)
+        for bet_id, bet_info in record["open_bets"].items():
+            used_bet_ids.add(bet_id)
+            if bet_info is None:
+                full_game_state["open_bets"].pop(bet_id, None)
+            else:
+                full_game_state["open_bets"][bet_id] = bet_info
+        full_game_state["next_bet_id"] = record.get("next_bet_id", full_game_state.get("next_bet_id"))
+        full_game_state["seq"] = record["seq"]
+    full_game_state["used_bet_ids"] = list(used_bet_ids)
+    return full_game_state
+
+
+async def load_game_state(user_resolver, storage, snapshot=None):
+    full_game_state = storage.read_state(snapshot)
+    storage.seq = max(storage.seq, full_game_state["seq"])
+
+    # users in open bets are fetched in the background so they're shown by
+    # name soon, everyone else the next time something needs more than their id
+    user_resolver.prefetch(participant_id for bet_info in full_game_state["open_bets"].values() for participant_id in bet_info["participants"])
+
+    open_bets = {}
+    for bet_id, bet_info in sorted(full_game_state["open_bets"].items(), key=lambda item: int(item[0])):
+        open_bets[bet_id] = {
+            "amount": bet_info["amount"],
+            "participants": [int(participant_id) for participant_id in bet_info["participants"]]
+        }
+        if bet_info.get("game_name"):
+            open_bets[bet_id]["game_name"] = bet_info.get("game_name")
+
+    return (full_game_state["game_state"],
+            open_bets,
+            BetIdAllocator(full_game_state.get("next_bet_id"), full_game_state["used_bet_ids"]))
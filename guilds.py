@@ -0,0 +1,87 @@
+import asyncio
+import os
+
+from leaderboard import RenderCache
+from snapshots import FILE_SUFFIX
+from state_engine import StateEngine
+
+GUILD_DIR = 'guilds'
+
+
+def shard_for(guild_id, shard_count):
+    # the shard discord sends a guild's events to
+    return (guild_id >> 22) % shard_count
+
+
+class GuildState:
+    # One charity event: its engine, its storage, its audit log and the
+    # renders cached from it. The state is read from storage the first time a
+    # command needs it.
+    def __init__(self, guild_id, storage, audit):
+        self.guild_id = guild_id
+        self.engine = StateEngine()
+        self.storage = storage
+        self.audit = audit
+        self.standings_cache = RenderCache()
+        self.open_bets_cache = RenderCache()
+        self.odds_cache = RenderCache()
+        self.loaded = False
+        self.load_lock = asyncio.Lock()
+
+
+class GuildRegistry:
+    # guild id -> GuildState. Every guild keeps its journal (or database) and
+    # snapshots in its own directory and has its own writer thread, so events
+    # in different servers never wait on the same lock or write the same file.
+    # open_storage(directory) and open_audit(directory) build a guild's storage
+    # and audit log the first time it's used.
+    def __init__(self, open_storage, open_audit, directory=GUILD_DIR):
+        self.open_storage = open_storage
+        self.open_audit = open_audit
+        self.directory = directory
+        self._guilds = {}
+
+    def __contains__(self, guild_id):
+        return guild_id in self._guilds
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def values(self):
+        return list(self._guilds.values())
+
+    def directory_for(self, guild_id):
+        return os.path.join(self.directory, str(guild_id))
+
+    def get(self, guild_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            directory = self.directory_for(guild_id)
+            os.makedirs(directory, exist_ok=True)
+            guild = self._guilds[guild_id] = GuildState(guild_id, self.open_storage(directory), self.open_audit(directory))
+        return guild
+
+    def saved_guild_ids(self):
+        # guilds that have state on disk from an earlier run
+        if not os.path.isdir(self.directory):
+            return []
+        return [int(name) for name in os.listdir(self.directory) if name.isdigit()]
+
+    def adopt_legacy_state(self, guild_id, names):
+        # one time move of the state older versions kept in the working
+        # directory into a guild's directory, unless that guild already has some
+        directory = self.directory_for(guild_id)
+        if os.path.exists(directory):
+            return []
+        moved = [name for name in names if os.path.exists(name)]
+        moved += sorted(name for name in os.listdir() if name.endswith(FILE_SUFFIX))
+        if moved:
+            os.makedirs(directory)
+            for name in moved:
+                os.replace(name, os.path.join(directory, name))
+        return moved
+
+    def close(self):
+        for guild in self._guilds.values():
+            guild.storage.close()
+            guild.audit.close()
@@ -0,0 +1,61 @@
+from bisect import bisect_left, insort
+
+
+class Leaderboard:
+    # User ids sorted by tickets (most first, ties by user id), updated one
+    # user at a time as tickets change instead of re-sorting for every
+    # standings. version moves on every change so rendered output can be cached.
+    def __init__(self, items=()):
+        self._tickets = {}
+        self._order = []
+        for user_id, tickets in items:
+            self._tickets[user_id] = tickets
+            self._order.append((-tickets, user_id))
+        self._order.sort()
+        self.version = 0
+
+    def __len__(self):
+        return len(self._order)
+
+    def update(self, user_id, tickets):
+        old_tickets = self._tickets.get(user_id)
+        if old_tickets == tickets:
+            return
+        if old_tickets is not None:
+            del self._order[bisect_left(self._order, (-old_tickets, user_id))]
+        insort(self._order, (-tickets, user_id))
+        self._tickets[user_id] = tickets
+        self.version += 1
+
+    def rank(self, user_id):
+        if user_id not in self._tickets:
+            return None
+        return bisect_left(self._order, (-self._tickets[user_id], user_id)) + 1
+
+    def top(self, count, start=0):
+        return [(rank, user_id, -negative_tickets)
+                for rank, (negative_tickets, user_id) in enumerate(self._order[start:start + count], start=start + 1)]
+
+
+class RenderCache:
+    # Keeps rendered text until the version it was rendered from changes
+    def __init__(self):
+        self.version = None
+        self._entries = {}
+
+    def get(self, key, version, render):
+        text = self.cached(key, version)
+        if text is None:
+            text = render()
+            self.put(key, version, text)
+        return text
+
+    def cached(self, key, version):
+        # None unless key was rendered from this version
+        return self._entries.get(key) if version == self.version else None
+
+    def put(self, key, version, text):
+        if version != self.version:
+            self.version = version
+            self._entries = {}
+        self._entries[key] = text
@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque
+import traceback
+
+from metrics import registry
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class LogPipeline:
+    # Commands queue log lines and move on. A background task packs as many
+    # queued lines as fit into each channel message and waits
+    # min_send_interval between sends to stay under the channel rate limit.
+    def __init__(self, send, message_size_limit, message_count_limit, max_queued_lines=1000, min_send_interval=1.0, overflow_policy='drop_oldest'):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown log overflow policy {overflow_policy}, expected one of {", ".join(OVERFLOW_POLICIES)}')
+        self.send = send
+        self.message_size_limit = message_size_limit
+        self.message_count_limit = message_count_limit
+        self.max_queued_lines = max_queued_lines
+        self.min_send_interval = min_send_interval
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self._lines = deque()
+        self._has_lines = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._task = None
+        self._closing = False
+
+    def pending(self):
+        # a method rather than __len__, which would make an idle pipeline falsy
+        return len(self._lines)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, msg):
+        if self._closing:
+            print(msg)
+            return
+
+        # long messages are cut the same way a direct send used to cut them
+        msg = msg[:self.message_size_limit * self.message_count_limit]
+        chunks = [msg[start:start + self.message_size_limit] for start in range(0, len(msg), self.message_size_limit)]
+        for chunk in chunks:
+            while len(self._lines) >= self.max_queued_lines:
+                if self.overflow_policy == 'block':
+                    self._has_space.clear()
+                    await self._has_space.wait()
+                elif self.overflow_policy == 'drop_newest':
+                    self.dropped += 1
+                    registry.inc('log_lines_dropped_total')
+                    break
+                else:
+                    self._lines.popleft()
+                    self.dropped += 1
+                    registry.inc('log_lines_dropped_total')
+            else:
+                self._lines.append(chunk)
+        self._has_lines.set()
+
+    def _next_message(self):
+        lines = []
+        size = 0
+        if self.dropped:
+            lines.append(f'({self.dropped} log lines dropped)')
+            size = len(lines[0])
+            self.dropped = 0
+        while self._lines and (not lines or size + len(self._lines[0]) + 1 <= self.message_size_limit):
+            line = self._lines.popleft()
+            lines.append(line)
+            size += len(line) + 1
+        if len(self._lines) < self.max_queued_lines:
+            self._has_space.set()
+        if not self._lines:
+            self._has_lines.clear()
+        return '\n'.join(lines)
+
+    async def _send_next(self):
+        message = self._next_message()
+        if not message:
+            return
+        try:
+            with registry.timer('log_send_seconds'):
+                await self.send(f'LOG: {message}')
+        except Exception:
+            traceback.print_exc()
+            print(message)
+
+    async def _run(self):
+        while True:
+            await self._has_lines.wait()
+            await self._send_next()
+            await asyncio.sleep(self.min_send_interval)
+
+    async def close(self, timeout=10):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await asyncio.wait_for(self._flush(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for line in self._lines:
+            print(line)
+        self._lines.clear()
+
+    async def _flush(self):
+        while self._lines or self.dropped:
+            await self._send_next()
@@ -0,0 +1,114 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        # estimated by interpolating inside the bucket the quantile falls in
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _label_string(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    # In-process counters, gauges and latency histograms, summarized by the
+    # !metrics command and served in the Prometheus text format. Everything is
+    # updated from the event loop; the journal's writer thread only sets plain
+    # attributes that gauges read.
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def set_gauge(self, name, value):
+        # value may be a callable, read every time the gauge is rendered
+        self.gauges[name] = value
+
+    def gauge(self, name):
+        value = self.gauges.get(name, 0)
+        return value() if callable(value) else value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render_prometheus(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'{name}{_label_string(labels)} {value}')
+        for name in sorted(self.gauges):
+            lines.append(f'{name} {self.gauge(name)}')
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_label_string(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_label_string(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{_label_string(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histograms_named(self, histogram_name):
+        return [(dict(labels), histogram) for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+                if name == histogram_name]
+
+
+registry = Metrics()
+
+
+async def start_metrics_server(metrics, host, port):
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=metrics.render_prometheus().encode(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,142 @@
+from bisect import bisect_right
+from random import Random, SystemRandom
+
+SEED_BITS = 32
+
+
+def new_seed():
+    return SystemRandom().getrandbits(SEED_BITS)
+
+
+class TicketPool:
+    # Fenwick tree over each entry's ticket count so a drawing is a prefix-sum
+    # search instead of a list with one element per ticket. Entries are kept
+    # sorted, however they arrived, so the same tickets and seed always draw
+    # the same winners, during a session or after a reload.
+    def __init__(self, items=()):
+        items = sorted((entry, max(tickets, 0)) for entry, tickets in items)
+        self._build([entry for entry, _ in items], [tickets for _, tickets in items])
+
+    def _build(self, entries, weights):
+        self._entries = [None] + entries
+        self._weights = [0] + weights
+        self._index = {entry: index for index, entry in enumerate(entries, start=1)}
+        self._tree = list(self._weights)
+        for index in range(1, len(self._tree)):
+            parent = index + (index & -index)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[index]
+        self.total = sum(self._weights)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, entry):
+        return entry in self._index
+
+    def items(self):
+        # (entry, tickets) for every entry with tickets in the pot
+        return [(entry, tickets) for entry, tickets in zip(self._entries[1:], self._weights[1:]) if tickets > 0]
+
+    def tickets(self, entry):
+        index = self._index.get(entry)
+        return self._weights[index] if index else 0
+
+    def _prefix_sum(self, index):
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def _add(self, entry):
+        if len(self._entries) > 1 and entry < self._entries[-1]:
+            # somewhere in the middle, so everything after it moves along one
+            position = bisect_right(self._entries, entry, 1)
+            self._build(self._entries[1:position] + [entry] + self._entries[position:],
+                        self._weights[1:position] + [0] + self._weights[position:])
+            return position
+        index = len(self._tree)
+        self._entries.append(entry)
+        self._weights.append(0)
+        self._tree.append(self._prefix_sum(index - 1) - self._prefix_sum(index - (index & -index)))
+        self._index[entry] = index
+        return index
+
+    def update(self, entry, tickets):
+        tickets = max(tickets, 0)
+        index = self._index.get(entry)
+        if index is None:
+            if not tickets:
+                return
+            index = self._add(entry)
+
+        delta = tickets - self._weights[index]
+        if not delta:
+            return
+        self._weights[index] = tickets
+        self.total += delta
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def pick(self, rng):
+        if self.total <= 0:
+            return None
+        target = rng.randrange(self.total)
+        index = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            candidate = index + step
+            if candidate < len(self._tree) and self._tree[candidate] <= target:
+                index = candidate
+                target -= self._tree[candidate]
+            step >>= 1
+        return self._entries[index + 1]
+
+    def draw(self, count=1, seed=None):
+        # each winning ticket leaves the pot before the next pick, same as
+        # running a single drawing several times in a row
+        rng = Random(seed)
+        winners = []
+        for _ in range(count):
+            winner = self.pick(rng)
+            if winner is None:
+                break
+            self.update(winner, self._weights[self._index[winner]] - 1)
+            winners.append(winner)
+        return winners
+
+
+def win_chance(tickets, total, prizes=1):
+    # exact chance that at least one of someone's tickets is among the prizes
+    # drawn, with each winning ticket leaving the pot as in TicketPool.draw
+    if tickets <= 0 or total <= 0:
+        return 0.0
+    lose = 1.0
+    for drawn in range(min(prizes, total)):
+        lose *= max(total - tickets - drawn, 0) / (total - drawn)
+    return 1 - lose
+
+
+def simulate_draws(items, prizes, trials, seed=None):
+    # Runs trials drawings of prizes winners without touching any state.
+    # Removing each winning ticket before the next pick makes a drawing a
+    # uniform sample of distinct tickets, so a trial is one random.sample of
+    # ticket numbers mapped to their holders by bisecting the running ticket
+    # totals. Returns entry -> number of trials it won at least one prize in.
+    entries = []
+    cumulative = []
+    total = 0
+    for entry, tickets in items:
+        total += tickets
+        entries.append(entry)
+        cumulative.append(total)
+    prizes = min(prizes, total)
+    rng = Random(seed)
+    tickets = range(total)
+    wins = [0] * len(entries)
+    for _ in range(trials):
+        for index in {bisect_right(cumulative, ticket) for ticket in rng.sample(tickets, prizes)}:
+            wins[index] += 1
+    return {entry: count for entry, count in zip(entries, wins) if count}
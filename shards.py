@@ -0,0 +1,49 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+RESTART_DELAY = 5
+
+
+def start_shard(shard_id, shard_count):
+    # each process reads the same .env, only which shard it is differs
+    env = dict(os.environ, SHARD_ID=str(shard_id), SHARD_COUNT=str(shard_count))
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')], env=env)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Run the bot as one local process per shard. Discord sends each guild to one shard, '
+                                                 'so each process owns the state of its own guilds and events scale out across cores.')
+    parser.add_argument('--shards', type=int, default=int(os.getenv('SHARD_COUNT', 2)))
+    parser.add_argument('--restart-delay', type=float, default=RESTART_DELAY, help='seconds to wait before restarting a shard that exited')
+    args = parser.parse_args()
+
+    processes = {shard_id: start_shard(shard_id, args.shards) for shard_id in range(args.shards)}
+    # stop every shard on ctrl-c or a service manager's SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(1)
+            for shard_id, process in processes.items():
+                if process.poll() is not None:
+                    print(f'Shard {shard_id} exited with {process.returncode}, restarting in {args.restart_delay}s')
+                    time.sleep(args.restart_delay)
+                    processes[shard_id] = start_shard(shard_id, args.shards)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in processes.values():
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import shutil
+
+from binary_snapshot import encode, open_snapshot
+from UserState import UserState
+
+FILE_SUFFIX = '-game_state.json'
+BINARY_SUFFIX = '-game_state.bin'
+SNAPSHOT_FORMATS = ('binary', 'json')
+SNAPSHOT_DIR = 'snapshots'
+MANIFEST_FILE = 'manifest.json'
+KEEP_LAST = 10
+KEEP_HOURLY = 24
+KEEP_DAILY = 30
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%H:%M:%S', '%H:%M')
+
+
+def parse_snapshot_time(text, now=None, whole_day=True):
+    # a bare time of day means today, a bare date the end of that day (or its start without whole_day)
+    now = now or datetime.now()
+    for time_format in TIME_FORMATS:
+        try:
+            when = datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+        if '%Y' not in time_format:
+            when = now.replace(hour=when.hour, minute=when.minute, second=when.second, microsecond=0)
+        elif '%H' not in time_format and whole_day:
+            when += timedelta(days=1, microseconds=-1)
+        return when
+    return None
+
+
+def _write_file(path, contents, mode='w'):
+    with open(path + '.tmp', mode) as save_file:
+        save_file.write(contents)
+        save_file.flush()
+        os.fsync(save_file.fileno())
+        size = save_file.tell()
+    os.replace(path + '.tmp', path)
+    return size
+
+
+def _write_json(path, data):
+    return _write_file(path, json.dumps(data))
+
+
+def to_json(data):
+    # the JSON layout older versions wrote, keyed by user id
+    return {
+        "seq": data["seq"],
+        "game_state": {user_id: {"tickets_available": tickets_available, "amount_owed": amount_owed, "paid": paid}
+                       for user_id, tickets_available, amount_owed, paid in data["users"]},
+        "open_bets": data["open_bets"],
+        "used_bet_ids": data["used_bet_ids"],
+        "next_bet_id": data["next_bet_id"]
+    }
+
+
+def from_json(data):
+    data["game_state"] = {int(user_id): UserState(tickets_available=user_state["tickets_available"],
+                                                  amount_owed=user_state["amount_owed"],
+                                                  paid=user_state.get("paid", 0))
+                          for user_id, user_state in data.get("game_state", {}).items()}
+    return data
+
+
+class SnapshotStore:
+    # Snapshots live in their own directory, listed oldest first in a manifest
+    # so finding one never lists the directory. After every write the newest
+    # keep_last are kept as they are, the newest snapshot of each of the last
+    # keep_hourly hours and keep_daily days is kept as a checkpoint (gzipped if
+    # compress is set) and everything else is deleted. The writer thread is
+    # the only thing that changes the manifest and it swaps in a new list, so
+    # the event loop can read entries at any time.
+    def __init__(self, directory=SNAPSHOT_DIR, keep_last=KEEP_LAST, keep_hourly=KEEP_HOURLY, keep_daily=KEEP_DAILY, compress=True, snapshot_format='binary'):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f'Unknown snapshot format {snapshot_format}, expected one of {", ".join(SNAPSHOT_FORMATS)}')
+        self.snapshot_format = snapshot_format
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+        self.compress = compress
+        self.manifest_file = os.path.join(directory, MANIFEST_FILE)
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as manifest:
+                self.entries = json.load(manifest)
+        else:
+            self.entries = self._adopt_legacy_snapshots()
+            self._save_manifest(self.entries)
+
+    def _adopt_legacy_snapshots(self):
+        # one time move of the snapshots older versions left next to the snapshot directory
+        parent = os.path.dirname(os.path.normpath(self.directory)) or '.'
+        entries = []
+        for file_name in sorted(candidate for candidate in os.listdir(parent) if candidate.endswith(FILE_SUFFIX)):
+            legacy_path = os.path.join(parent, file_name)
+            try:
+                when = datetime.strptime(file_name[:-len(FILE_SUFFIX)], '%y%m%d%H%M%S')
+            except ValueError:
+                when = datetime.fromtimestamp(os.path.getmtime(legacy_path))
+            os.replace(legacy_path, os.path.join(self.directory, file_name))
+            entries.append({"file": file_name, "time": when.timestamp(), "seq": None,
+                            "bytes": os.path.getsize(os.path.join(self.directory, file_name))})
+        return entries
+
+    def _save_manifest(self, entries):
+        _write_json(self.manifest_file, entries)
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry["file"])
+
+    def latest(self):
+        return self.entries[-1] if self.entries else None
+
+    def find(self, text):
+        # an exact snapshot file name, or the newest snapshot taken at or before a time
+        for entry in reversed(self.entries):
+            if entry["file"] == text or entry["file"] == text + '.gz':
+                return entry
+        when = parse_snapshot_time(text)
+        if when is None:
+            return None
+        for entry in reversed(self.entries):
+            if entry["time"] <= when.timestamp():
+                return entry
+        return None
+
+    def read(self, entry):
+        # game_state comes back as user id -> UserState, built lazily for binary snapshots
+        path = self.path(entry)
+        compressed = path.endswith('.gz')
+        if (path[:-3] if compressed else path).endswith(BINARY_SUFFIX):
+            if compressed:
+                with gzip.open(path, 'rb') as load_file:
+                    return open_snapshot(path, load_file.read())
+            return open_snapshot(path)
+        with (gzip.open(path, 'rt') if compressed else open(path, 'r')) as load_file:
+            return from_json(json.load(load_file))
+
+    def write(self, data):
+        # data is snapshot_data() output
+        now = datetime.now()
+        if self.snapshot_format == 'binary':
+            file_name = now.strftime('%Y%m%d-%H%M%S-%f') + BINARY_SUFFIX
+            size = _write_file(os.path.join(self.directory, file_name), encode(data), 'wb')
+        else:
+            file_name = now.strftime('%Y%m%d-%H%M%S-%f') + FILE_SUFFIX
+            size = _write_json(os.path.join(self.directory, file_name), to_json(data))
+        entries = self.entries + [{"file": file_name, "time": now.timestamp(), "seq": data.get("seq"), "bytes": size}]
+        kept = self._apply_retention(entries)
+        # the manifest is replaced before anything is deleted, so it never lists a missing file
+        self._save_manifest(kept)
+        self.entries = kept
+        self._remove_unlisted({entry["file"] for entry in entries}, kept)
+        return size
+
+    def _apply_retention(self, entries):
+        recent = entries[-self.keep_last:] if self.keep_last else []
+        checkpoints = {}
+        for entry in entries:
+            when = datetime.fromtimestamp(entry["time"])
+            # later entries overwrite earlier ones, leaving the newest per hour and day
+            checkpoints[('hour', when.strftime('%Y%m%d%H'))] = entry["file"]
+            checkpoints[('day', when.strftime('%Y%m%d'))] = entry["file"]
+        keep = set()
+        for period, limit in (('hour', self.keep_hourly), ('day', self.keep_daily)):
+            buckets = sorted(bucket for kind, bucket in checkpoints if kind == period)
+            keep.update(checkpoints[(period, bucket)] for bucket in (buckets[-limit:] if limit else []))
+
+        kept = []
+        recent_files = {entry["file"] for entry in recent}
+        for entry in entries:
+            if entry["file"] in recent_files:
+                kept.append(entry)
+            elif entry["file"] in keep:
+                kept.append(self._compressed(entry) if self.compress else entry)
+        return kept
+
+    def _compressed(self, entry):
+        if entry["file"].endswith('.gz'):
+            return entry
+        path = self.path(entry)
+        with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        return dict(entry, file=entry["file"] + '.gz', bytes=os.path.getsize(path + '.gz'))
+
+    def _remove_unlisted(self, previous_files, entries):
+        # only files the manifest knew about, so nothing else in the directory is touched
+        listed = {entry["file"] for entry in entries}
+        for file_name in previous_files - listed:
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
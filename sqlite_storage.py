@@ -0,0 +1,213 @@
+import argparse
+from datetime import datetime
+import os
+import sqlite3
+
+from bet_ids import BetIdAllocator
+from file_management import COMPACT_EVERY, JOURNAL_FILE, Storage, read_json_state, snapshot_data
+from snapshots import SNAPSHOT_DIR, SnapshotStore
+from UserState import UserState
+
+DB_FILE = 'game_state.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    tickets_available INTEGER NOT NULL,
+    amount_owed INTEGER NOT NULL,
+    paid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bets (
+    bet_id TEXT PRIMARY KEY,
+    amount INTEGER NOT NULL,
+    game_name TEXT,
+    open INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bets_open ON bets (open);
+CREATE TABLE IF NOT EXISTS participants (
+    bet_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (bet_id, position)
+);
+CREATE INDEX IF NOT EXISTS participants_user ON participants (user_id);
+CREATE TABLE IF NOT EXISTS ledger (
+    entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    seq INTEGER NOT NULL,
+    recorded_at TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    tickets_change INTEGER NOT NULL,
+    owed_change INTEGER NOT NULL,
+    paid_change INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+'''
+
+
+def connect(db_file):
+    connection = sqlite3.connect(db_file, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # a commit has reached the disk by the time its command is told so, same as the journal's fsync
+    connection.execute('PRAGMA synchronous=FULL')
+    # the WAL is emptied when a checkpoint resets it, so it only grows by what
+    # each transaction appends, which is how SqliteStorage counts bytes written
+    connection.execute('PRAGMA journal_size_limit=0')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _write_user(connection, seq, recorded_at, user_id, user_state):
+    old = connection.execute('SELECT tickets_available, amount_owed, paid FROM users WHERE user_id = ?', (user_id,)).fetchone() or (0, 0, 0)
+    connection.execute('INSERT OR REPLACE INTO users (user_id, tickets_available, amount_owed, paid) VALUES (?, ?, ?, ?)',
+                       (user_id, user_state["tickets_available"], user_state["amount_owed"], user_state["paid"]))
+    changes = (user_state["tickets_available"] - old[0], user_state["amount_owed"] - old[1], user_state["paid"] - old[2])
+    if any(changes):
+        connection.execute('INSERT INTO ledger (seq, recorded_at, user_id, tickets_change, owed_change, paid_change) VALUES (?, ?, ?, ?, ?, ?)',
+                           (seq, recorded_at) + (user_id,) + changes)
+
+
+def _write_bet(connection, bet_id, bet_info):
+    connection.execute('INSERT OR REPLACE INTO bets (bet_id, amount, game_name, open) VALUES (?, ?, ?, 1)',
+                       (bet_id, bet_info["amount"], bet_info["game_name"]))
+    connection.execute('DELETE FROM participants WHERE bet_id = ?', (bet_id,))
+    connection.executemany('INSERT INTO participants (bet_id, position, user_id) VALUES (?, ?, ?)',
+                           [(bet_id, position, participant) for position, participant in enumerate(bet_info["participants"])])
+
+
+def _write_meta(connection, seq, next_bet_id):
+    connection.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [('seq', seq), ('next_bet_id', next_bet_id)])
+
+
+def write_full_state(connection, data):
+    # replaces the current users and open bets; closed bets and the ledger are history and stay
+    with connection:
+        connection.execute('DELETE FROM users')
+        connection.executemany('INSERT INTO users (user_id, tickets_available, amount_owed, paid) VALUES (?, ?, ?, ?)', data["users"])
+        connection.execute('UPDATE bets SET open = 0 WHERE open = 1')
+        for bet_id, bet_info in data["open_bets"].items():
+            _write_bet(connection, bet_id, {"amount": bet_info["amount"],
+                                            "participants": [int(participant) for participant in bet_info["participants"]],
+                                            "game_name": bet_info.get("game_name")})
+        connection.executemany('INSERT OR IGNORE INTO bets (bet_id, amount, game_name, open) VALUES (?, 0, NULL, 0)',
+                               [(bet_id,) for bet_id in data["used_bet_ids"]])
+        _write_meta(connection, data["seq"], data.get("next_bet_id"))
+
+
+def read_full_state(connection):
+    meta = dict(connection.execute('SELECT key, value FROM meta'))
+    if 'seq' not in meta:
+        return None
+    open_bets = {}
+    for bet_id, amount, game_name in connection.execute('SELECT bet_id, amount, game_name FROM bets WHERE open = 1'):
+        open_bets[bet_id] = {"amount": amount, "participants": [], "game_name": game_name}
+    for bet_id, user_id in connection.execute('SELECT participants.bet_id, participants.user_id FROM participants JOIN bets ON bets.bet_id = participants.bet_id '
+                                              'WHERE bets.open = 1 ORDER BY participants.bet_id, participants.position'):
+        open_bets[bet_id]["participants"].append(user_id)
+    return {
+        "seq": meta["seq"],
+        "game_state": {user_id: UserState(tickets_available=tickets_available, amount_owed=amount_owed, paid=paid)
+                       for user_id, tickets_available, amount_owed, paid in connection.execute('SELECT user_id, tickets_available, amount_owed, paid FROM users')},
+        "open_bets": open_bets,
+        "used_bet_ids": [bet_id for bet_id, in connection.execute('SELECT bet_id FROM bets')],
+        "next_bet_id": meta.get("next_bet_id")
+    }
+
+
+class SqliteStorage(Storage):
+    # Keeps the state in a SQLite database in WAL mode. Each record updates
+    # only the rows for the users and bets it touched and adds a ledger row
+    # per user change, with every record in a batch sharing one transaction.
+    # There is nothing to compact, so compact() only happens on load, where it
+    # rewrites the current users and open bets in one go.
+    def __init__(self, db_file=DB_FILE, compact_every=COMPACT_EVERY, snapshots=None):
+        self.db_file = db_file
+        self._connection = connect(db_file)
+        super().__init__(compact_every, snapshots)
+        self._update_sizes()
+
+    def should_compact(self):
+        return False
+
+    def close(self):
+        super().close()
+        self._connection.close()
+
+    def read_state(self, snapshot=None):
+        # a chosen JSON snapshot is being imported
+        if snapshot:
+            return read_json_state(self.snapshots, snapshot)
+        connection = sqlite3.connect(self.db_file)
+        try:
+            full_game_state = read_full_state(connection)
+        finally:
+            connection.close()
+        # a database that has never been written picks up where the JSON
+        # snapshots and journal left off
+        if full_game_state is None:
+            full_game_state = read_json_state(self.snapshots, journal_file=os.path.join(os.path.dirname(self.db_file), JOURNAL_FILE))
+        return full_game_state
+
+    def _commit(self, entries):
+        recorded_at = datetime.now().isoformat(timespec='seconds')
+        wal_before = self.journal_bytes
+        with self._connection:
+            for entry in entries:
+                for user_id, user_state in entry["game_state"].items():
+                    _write_user(self._connection, entry["seq"], recorded_at, user_id, user_state)
+                for bet_id, bet_info in entry["open_bets"].items():
+                    if bet_info is None:
+                        self._connection.execute('UPDATE bets SET open = 0 WHERE bet_id = ?', (bet_id,))
+                    else:
+                        _write_bet(self._connection, bet_id, bet_info)
+            _write_meta(self._connection, entries[-1]["seq"], entries[-1]["next_bet_id"])
+        self._update_sizes()
+        return self._wal_written(wal_before)
+
+    def _snapshot(self, data):
+        wal_before = self.journal_bytes
+        write_full_state(self._connection, data)
+        self._update_sizes()
+        return self._wal_written(wal_before)
+
+    def _wal_written(self, wal_before):
+        # A smaller WAL was reset by a checkpoint and holds only this
+        # transaction. Pages a checkpoint copies into the database aren't counted.
+        return self.journal_bytes - wal_before if self.journal_bytes >= wal_before else self.journal_bytes
+
+    def _update_sizes(self):
+        self.snapshot_bytes = os.path.getsize(self.db_file)
+        wal_file = self.db_file + '-wal'
+        self.journal_bytes = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a JSON game state snapshot (plus the journal, if no snapshot is picked) into the SQLite database')
+    parser.add_argument('snapshot', nargs='?', help='snapshot file name or time to import, the newest snapshot by default')
+    parser.add_argument('--directory', default='.', help='state directory holding the snapshots, journal and database, guilds/<guild id> for the bot')
+    parser.add_argument('--db', help=f'database file, {DB_FILE} in the state directory by default')
+    args = parser.parse_args()
+
+    snapshots = SnapshotStore(os.path.join(args.directory, SNAPSHOT_DIR))
+    db_file = args.db or os.path.join(args.directory, DB_FILE)
+    snapshot = None
+    if args.snapshot:
+        snapshot = snapshots.find(args.snapshot)
+        if snapshot is None:
+            parser.error(f'No snapshot matches {args.snapshot}')
+    full_game_state = read_json_state(snapshots, snapshot, os.path.join(args.directory, JOURNAL_FILE))
+    data = snapshot_data(full_game_state["game_state"], full_game_state["open_bets"],
+                         BetIdAllocator(full_game_state.get("next_bet_id"), full_game_state["used_bet_ids"]), full_game_state["seq"])
+    connection = connect(db_file)
+    try:
+        write_full_state(connection, data)
+    finally:
+        connection.close()
+    print(f'Imported {len(data["users"])} users and {len(data["open_bets"])} open bets into {db_file}')
+
+
+if __name__ == '__main__':
+    main()
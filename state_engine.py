@@ -0,0 +1,224 @@
+import asyncio
+from contextlib import asynccontextmanager
+from math import floor
+
+from bet_ids import BetIdAllocator
+from binary_snapshot import LazyGameState
+from bulk_import import BUYIN
+from leaderboard import Leaderboard
+from raffle import TicketPool
+from UserState import UserState
+
+NOT_REGISTERED = 'not registered'
+NOT_ENOUGH_TICKETS = 'not enough tickets'
+DUPLICATE_GAME_NAME = 'duplicate game name'
+
+
+class StateEngine:
+    # Every change to game_state and open_bets goes through here. Users are
+    # identified by their integer discord id throughout. Each method
+    # checks and applies its whole change without awaiting, so a command has
+    # committed everything (or nothing) before it sends any messages. Commands
+    # hold the users they touch with locked(), which takes one lock per user in
+    # user id order so bets between overlapping groups can't deadlock and
+    # commands for unrelated users never wait on each other.
+    def __init__(self, game_state=None, open_bets=None, bet_ids=None):
+        self._locks = {}
+        self.generation = 0
+        self.load(game_state or {}, open_bets or {}, bet_ids or BetIdAllocator())
+
+    def load(self, game_state, open_bets, bet_ids):
+        self.game_state = game_state
+        self.open_bets = open_bets
+        self.bet_ids = bet_ids
+        # a lazily loaded game_state hands over ticket counts without building every UserState
+        if isinstance(game_state, LazyGameState):
+            tickets = [(user, tickets_available) for user, tickets_available, _, _ in game_state.rows()]
+        else:
+            tickets = [(user, state.tickets_available) for user, state in game_state.items()]
+        self.ticket_pool = TicketPool(tickets)
+        self.leaderboard = Leaderboard(tickets)
+        # bumped on every load so cached renders of the old state are dropped
+        self.generation += 1
+        self.bets_version = 0
+        # (user id, game name) -> bet id and user id -> set of bet ids, so
+        # neither lookup scans. open_bets itself stays in bet id order.
+        self.bet_by_name = {}
+        self.bets_by_user = {}
+        for bet_id, bet_info in open_bets.items():
+            self._index_bet(bet_id, bet_info)
+        self.dirty_users = set()
+        self.dirty_bets = set()
+
+    def __contains__(self, user):
+        return user in self.game_state
+
+    def __getitem__(self, user):
+        return self.game_state[user]
+
+    def _lock(self, user_id):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def locked(self, *users):
+        locks = [self._lock(user_id) for user_id in sorted(set(users))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def _touch_user(self, user):
+        self.ticket_pool.update(user, self.game_state[user].tickets_available)
+        self.leaderboard.update(user, self.game_state[user].tickets_available)
+        self.dirty_users.add(user)
+
+    @property
+    def standings_version(self):
+        return (self.generation, self.leaderboard.version)
+
+    @property
+    def open_bets_version(self):
+        return (self.generation, self.bets_version)
+
+    def take_changes(self):
+        # A command calls this right after its change, before it awaits
+        # anything, so what comes back is its own change and nobody else's
+        users, bets = list(self.dirty_users), list(self.dirty_bets)
+        self.dirty_users.clear()
+        self.dirty_bets.clear()
+        return users, bets
+
+    def register(self, user):
+        if user in self.game_state:
+            return False
+        self.game_state[user] = UserState()
+        self._touch_user(user)
+        return True
+
+    def buyin(self, user, money_amount):
+        self.register(user)
+        self.game_state[user].buyin(money_amount)
+        self._touch_user(user)
+
+    def pay(self, user, amount):
+        self.game_state[user].pay(amount)
+        self._touch_user(user)
+
+    def set_user(self, user, tickets_available=0, amount_owed=0, paid=0):
+        self.game_state[user] = UserState(tickets_available=tickets_available, amount_owed=amount_owed, paid=paid)
+        self._touch_user(user)
+
+    def apply_transactions(self, transactions):
+        # bulk imported buy-ins and payments, checked beforehand
+        for transaction in transactions:
+            if transaction.kind == BUYIN:
+                self.buyin(transaction.user_id, transaction.amount)
+            else:
+                self.pay(transaction.user_id, transaction.amount)
+
+    def totals(self):
+        total_owed = 0
+        total_paid = 0
+        for user_state in self.game_state.values():
+            total_owed += user_state.amount_owed
+            total_paid += user_state.paid
+        return total_owed, total_paid
+
+    def _index_bet(self, bet_id, bet_info):
+        for participant in bet_info["participants"]:
+            self.bets_by_user.setdefault(participant, set()).add(bet_id)
+            if bet_info.get("game_name"):
+                self.bet_by_name[(participant, bet_info["game_name"])] = bet_id
+
+    def _unindex_bet(self, bet_id, bet_info):
+        for participant in bet_info["participants"]:
+            user_bets = self.bets_by_user.get(participant)
+            if user_bets is not None:
+                user_bets.discard(bet_id)
+                if not user_bets:
+                    del self.bets_by_user[participant]
+            if bet_info.get("game_name"):
+                self.bet_by_name.pop((participant, bet_info["game_name"]), None)
+
+    def find_bet_by_game_name(self, user, game_name):
+        return self.bet_by_name.get((user, game_name.strip().lower()))
+
+    def user_bets(self, user):
+        return sorted(self.bets_by_user.get(user, ()), key=int)
+
+    def bet_problems(self, participants, amount, game_name=None):
+        problems = []
+        for participant in participants:
+            if participant not in self.game_state:
+                problems.append((participant, NOT_REGISTERED))
+            elif self.game_state[participant].tickets_available < amount:
+                problems.append((participant, NOT_ENOUGH_TICKETS))
+            elif game_name and self.find_bet_by_game_name(participant, game_name):
+                problems.append((participant, DUPLICATE_GAME_NAME))
+        return problems
+
+    def create_bet(self, participants, amount, game_name=None):
+        problems = self.bet_problems(participants, amount, game_name)
+        if problems:
+            return None, problems
+
+        bet_id = self.bet_ids.allocate()
+        bet = {
+            "amount": 0,
+            "participants": []
+        }
+        if game_name:
+            bet["game_name"] = game_name
+
+        for participant in participants:
+            bet["amount"] += amount
+            bet["participants"].append(participant)
+            self.game_state[participant].tickets_available -= amount
+            self._touch_user(participant)
+
+        self.open_bets[bet_id] = bet
+        self._index_bet(bet_id, bet)
+        self.bets_version += 1
+        self.dirty_bets.add(bet_id)
+        return bet_id, []
+
+    def settle_bet(self, bet_id, winners):
+        bet = self.open_bets[bet_id]
+        amount_per_winner = floor(bet["amount"] / len(winners))
+        remainder = bet["amount"] - len(winners) * amount_per_winner
+
+        awards = []
+        for winner in winners:
+            if remainder > 0:
+                remainder -= 1
+                amount_awarded = amount_per_winner + 1
+            else:
+                amount_awarded = amount_per_winner
+            self.game_state[winner].tickets_available += amount_awarded
+            self._touch_user(winner)
+            awards.append((winner, amount_awarded))
+
+        self._unindex_bet(bet_id, bet)
+        del self.open_bets[bet_id]
+        self.bets_version += 1
+        self.dirty_bets.add(bet_id)
+        return awards
+
+    def settle_bets(self, settlements):
+        # [(bet id, winners)] checked beforehand, all applied without awaiting
+        return [(bet_id, self.settle_bet(bet_id, winners)) for bet_id, winners in settlements]
+
+    def draw(self, count, seed):
+        winners = self.ticket_pool.draw(count, seed)
+        for winner in winners:
+            self.game_state[winner].tickets_available -= 1
+            self._touch_user(winner)
+        return winners
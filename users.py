@@ -0,0 +1,104 @@
+import asyncio
+import traceback
+
+MAX_CONCURRENT_FETCHES = 10
+
+
+class LazyUser:
+    # Stands in for a discord User that hasn't been fetched yet. It hashes and
+    # compares like the real user, can mention them without a lookup and only
+    # hits the API when something needs more than the id.
+    def __init__(self, user_id, resolver):
+        self.id = user_id
+        self.user = None
+        self._resolver = resolver
+
+    def __hash__(self):
+        return self.id >> 22
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return str(self.user) if self.user else f'<@{self.id}>'
+
+    def __getattr__(self, name):
+        user = self.__dict__.get('user')
+        if user is None:
+            raise AttributeError(f'user {self.id} has not been resolved, cannot get {name}')
+        return getattr(user, name)
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    @property
+    def display_name(self):
+        return self.user.display_name if self.user else str(self)
+
+    async def send(self, *args, **kwargs):
+        user = await self._resolver.resolve(self.id)
+        return await user.send(*args, **kwargs)
+
+
+class UserResolver:
+    # Shared id -> user cache. The gateway cache is tried first, anything else
+    # is handed out as a LazyUser and fetched at most once, with a bounded
+    # number of fetches in flight.
+    def __init__(self, bot, max_concurrent_fetches=MAX_CONCURRENT_FETCHES):
+        self.bot = bot
+        self.max_concurrent_fetches = max_concurrent_fetches
+        self.users = {}
+        self._pending = {}
+        self._fetch_slots = None
+
+    def get(self, user_id):
+        user_id = int(user_id)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.bot.get_user(user_id) or LazyUser(user_id, self)
+            self.users[user_id] = user
+        return user
+
+    def adopt(self, user):
+        known = self.users.get(user.id)
+        if known is None:
+            self.users[user.id] = user
+        elif isinstance(known, LazyUser) and known.user is None:
+            known.user = user
+
+    async def resolve(self, user_id):
+        known = self.get(user_id)
+        if not isinstance(known, LazyUser):
+            return known
+        if known.user is not None:
+            return known.user
+
+        if known.id not in self._pending:
+            self._pending[known.id] = asyncio.ensure_future(self._fetch(known))
+        return await asyncio.shield(self._pending[known.id])
+
+    async def resolve_many(self, user_ids):
+        return await asyncio.gather(*[self.resolve(user_id) for user_id in {int(user_id) for user_id in user_ids}])
+
+    def prefetch(self, user_ids):
+        # resolve in the background, nothing waits on it
+        async def resolve_quietly(user_ids):
+            try:
+                await self.resolve_many(user_ids)
+            except Exception:
+                traceback.print_exc()
+        return asyncio.ensure_future(resolve_quietly(list(user_ids)))
+
+    async def _fetch(self, lazy_user):
+        if self._fetch_slots is None:
+            self._fetch_slots = asyncio.Semaphore(self.max_concurrent_fetches)
+        try:
+            async with self._fetch_slots:
+                lazy_user.user = await self.bot.fetch_user(lazy_user.id)
+            return lazy_user.user
+        finally:
+            del self._pending[lazy_user.id]